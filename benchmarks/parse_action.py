@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Compares parsing a webhook action into trello.Action models and into
+records.ActionRecord: time per parse and memory held per parsed action.
+
+Run from the repository root: python -m benchmarks.parse_action
+"""
+import timeit
+import tracemalloc
+
+from bot import rendering, trello
+from bot.records import ActionRecord
+
+PAYLOAD = {
+    'id': '5a1b2c3d4e5f60718293a4b5',
+    'idMemberCreator': '4f5e6d7c8b9a0f1e2d3c4b5a',
+    'type': 'updateCard',
+    'date': '2016-09-01T12:00:00.000Z',
+    'data': {
+        'board': {'id': '57c0ffee57c0ffee57c0ffee', 'name': 'Development',
+                  'shortLink': 'AbCdEfGh'},
+        'card': {'id': '57cafe0057cafe0057cafe00', 'name': 'Fix the login form',
+                 'idShort': 42, 'shortLink': 'HgFeDcBa', 'idList': '57ba5e0057ba5e0057ba5e00'},
+        'listBefore': {'id': '57ba5e0057ba5e0057ba5e01', 'name': 'To Do'},
+        'listAfter': {'id': '57ba5e0057ba5e0057ba5e00', 'name': 'Doing'},
+        'old': {'idList': '57ba5e0057ba5e0057ba5e01'},
+    },
+    'memberCreator': {'id': '4f5e6d7c8b9a0f1e2d3c4b5a', 'username': 'ivan',
+                      'fullName': 'Ivan Ivanov', 'initials': 'II', 'avatarHash': None},
+}
+
+UNSUPPORTED_PAYLOAD = dict(PAYLOAD, type='addLabelToCard',
+                           data={k: v for (k, v) in PAYLOAD['data'].items() if k != 'old'})
+
+COUNT = 10000
+
+
+def measure_memory(parse):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    parsed = [parse() for _ in range(COUNT)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    size = sum(s.size_diff for s in after.compare_to(before, 'filename'))
+    del parsed
+    return size / COUNT
+
+
+def report(name, parse):
+    seconds = min(timeit.repeat(parse, number=COUNT, repeat=5)) / COUNT
+    print("{:<40} {:>8.2f} us/parse {:>8.0f} B/action".format(
+        name, seconds * 1e6, measure_memory(parse)))
+
+
+def main():
+    app = trello.App('key')
+    session = app.session('token')
+
+    report("trello.Action.from_dict",
+           lambda: trello.Action.from_dict(session, PAYLOAD))
+    report("ActionRecord.from_payload",
+           lambda: ActionRecord.from_payload(PAYLOAD, rendering.event_bit,
+                                             app.members_cache))
+    report("trello.Action.from_dict, unsupported",
+           lambda: trello.Action.from_dict(session, UNSUPPORTED_PAYLOAD))
+    report("ActionRecord.from_payload, unsupported",
+           lambda: ActionRecord.from_payload(UNSUPPORTED_PAYLOAD, rendering.event_bit,
+                                             app.members_cache))
+
+
+if __name__ == '__main__':
+    main()
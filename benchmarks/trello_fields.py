@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Compares Trello API responses with all fields and with the minimal field
+sets of the trello.py models: bytes transferred and time to parse them
+into models.
+
+Needs a Trello API key and token with access to at least one board:
+
+    TRELLO_KEY=... TRELLO_TOKEN=... python -m benchmarks.trello_fields
+"""
+import json
+import os
+import timeit
+
+import requests
+
+from bot import trello
+
+REPEAT = 20
+
+
+def endpoints(session):
+    """
+    Returns (name, url, full params, minimal params, model class) tuples
+    for the resources the bot requests.
+    """
+    me = session.members.me()
+    board = me.boards(filter='open')[0]
+    lst = board.lists()[0]
+
+    actions_params = trello._fields_params(trello.Action.fields)
+    actions_params.update(trello._fields_params(trello.Member.fields, 'member_'))
+    actions_params.update(trello._fields_params(trello.Member.fields, 'memberCreator_'))
+
+    return [
+        ("members/me", '/members/me', {},
+         trello._fields_params(trello.Member.fields), trello.Member),
+        ("members/me/boards", '/members/me/boards', {'filter': 'open'},
+         dict(trello._fields_params(trello.Board.fields), filter='open'), trello.Board),
+        ("boards/{id}", board._sub_url(''), {},
+         trello._fields_params(trello.Board.fields), trello.Board),
+        ("boards/{id}/lists", board._sub_url('/lists'), {},
+         trello._fields_params(trello.List.fields), trello.List),
+        ("boards/{id}/members", board._sub_url('/members'), {},
+         trello._fields_params(trello.Member.fields), trello.Member),
+        ("boards/{id}/actions", board._sub_url('/actions'), {},
+         actions_params, trello.Action),
+        ("lists/{id}/cards", lst._sub_url('/cards'), {},
+         trello._fields_params(trello.Card.fields), trello.Card),
+        ("tokens/{token}/webhooks", '/tokens/{}/webhooks'.format(session.token), {},
+         trello._fields_params(trello.Webhook.fields), trello.Webhook),
+    ]
+
+
+def fetch(session, url, params):
+    params = dict(params, key=session.app.key, token=session.token)
+    r = requests.get(trello.TRELLO_API_URL + url, params=params)
+    r.raise_for_status()
+    return r.content
+
+
+def parse_seconds(session, content, model_class):
+    def parse():
+        json_ = json.loads(content.decode('utf-8'))
+        if isinstance(json_, list):
+            return [model_class.from_dict(session, d) for d in json_]
+        return model_class.from_dict(session, json_)
+
+    return min(timeit.repeat(parse, number=REPEAT, repeat=5)) / REPEAT
+
+
+def main():
+    app = trello.App(os.environ['TRELLO_KEY'])
+    session = app.session(os.environ['TRELLO_TOKEN'])
+
+    print("{:<26} {:>10} {:>10} {:>12} {:>12}".format(
+        "endpoint", "full B", "fields B", "full us", "fields us"))
+
+    for (name, url, full_params, params, model_class) in endpoints(session):
+        full = fetch(session, url, full_params)
+        minimal = fetch(session, url, params)
+
+        print("{:<26} {:>10} {:>10} {:>12.1f} {:>12.1f}".format(
+            name, len(full), len(minimal),
+            parse_seconds(session, full, model_class) * 1e6,
+            parse_seconds(session, minimal, model_class) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,16 @@
+import bisect
 import logging
 from typing import *
 
 import config
-from bot import models, trello, messages, trello_wh
+from bot import models, reconciler, routing, subscriptions, trello, trello_async, messages, trello_wh
 from bot.base_bot import BaseBot, Context, Dialog
 
 logger = logging.getLogger(__name__)
 
+# Boards shown at a time by the /notify board picker
+NOTIFY_PAGE_SIZE = 20
+
 
 def user_display(user):
     return "{}:{}".format(user.id, user.username)
@@ -19,23 +23,50 @@ def chat_display(chat):
 class AddHookDialog(Dialog):
 
     def __init__(self, boards):
-        self.boards = boards
-        self.board_options = [ b.name for b in self.boards ]
-        self.board_map = { b.name: b for b in self.boards }
+        # Sorted by case folded name, for pages and prefix search
+        self.index = sorted((b.name.casefold(), b.name, b.id) for b in boards)
+        self.board_ids = { b.name: b.id for b in boards }
+
+        self.matches = self.index
+        self.page = 0
 
         super().__init__()
 
+    def _search(self, prefix):
+        prefix = prefix.casefold()
+        start = bisect.bisect_left(self.index, (prefix,))
+        end = bisect.bisect_left(self.index, (prefix + '\U0010ffff',))
+        return self.index[start:end]
+
+    @property
+    def pages(self):
+        return max(1, (len(self.matches) + NOTIFY_PAGE_SIZE - 1) // NOTIFY_PAGE_SIZE)
+
     def step1(self, ctx: Context):
-        try:
-            board = self.board_map[ctx.text]
-        except KeyError:
-            ctx.send_message(messages.NOTIFY_NOBOARD)
+        if ctx.text == messages.NOTIFY_PREV:
+            self.page = max(self.page - 1, 0)
+            return False
+        if ctx.text == messages.NOTIFY_NEXT:
+            self.page = min(self.page + 1, self.pages - 1)
             return False
 
+        board_id = self.board_ids.get(ctx.text)
+        if board_id is None:
+            matches = self._search(ctx.text)
+            if not matches:
+                ctx.send_message(messages.NOTIFY_NOTFOUND.format(ctx.text))
+                return False
+            if len(matches) > 1:
+                self.matches = matches
+                self.page = 0
+                return False
+            board_id = matches[0][2]
+
         try:
             ctx.trello_session.webhooks.add(
-                callbackURL=ctx.base_bot.wh_reciever.callback_url(ctx.chat_id),
-                idModel=board.id,
+                callbackURL=ctx.base_bot.wh_reciever.board_callback_url(
+                    board_id, ctx.session.trello_token),
+                idModel=board_id,
             )
         except trello.TrelloError as e:
             text = str(e)
@@ -43,7 +74,9 @@ class AddHookDialog(Dialog):
                 ctx.send_message('```' + text + '```')
                 return True
 
-        (hook, created) = models.BoardHook.get_or_create(session=ctx.session, board_id=board.id)
+        (hook, created) = models.BoardHook.get_or_create(session=ctx.session, board_id=board_id)
+        ctx.base_bot.routes.add_hook(ctx.chat_id, board_id, hook.id,
+                                     subscriptions.Subscription.of_hook(hook))
         if not created:
             ctx.send_message(messages.NOTIFY_ALREADY)
             return True
@@ -51,11 +84,26 @@ class AddHookDialog(Dialog):
         ctx.send_message(messages.NOTIFY_SUCCESS)
         return True
 
-    step1_message = messages.NOTIFY_DLG_MSG
+    @property
+    def step1_message(self):
+        if len(self.index) <= NOTIFY_PAGE_SIZE:
+            return messages.NOTIFY_DLG_MSG
+        return messages.NOTIFY_SEARCH_MSG.format(page=self.page + 1, pages=self.pages)
 
     @property
     def step1_options(self):
-        return self.board_options
+        start = self.page * NOTIFY_PAGE_SIZE
+        options = [name for (_, name, _) in self.matches[start:start + NOTIFY_PAGE_SIZE]]
+
+        nav = []
+        if self.page > 0:
+            nav.append(messages.NOTIFY_PREV)
+        if self.page < self.pages - 1:
+            nav.append(messages.NOTIFY_NEXT)
+        if nav:
+            options.append(nav)
+
+        return options
 
     def cancel(self, ctx: Context):
         ctx.send_message(messages.NOTIFY_CANCELLED)
@@ -63,18 +111,20 @@ class AddHookDialog(Dialog):
 
 class ForgetHookDialog(Dialog):
     def __init__(self, hook_map):
-        self.hook_map = hook_map
+        self.hook_map = hook_map # Board name -> (hook id, board id)
         self.hook_options = list(self.hook_map.keys())
         super().__init__()
 
     def step1(self, ctx: Context):
         try:
-            hook = self.hook_map[ctx.text]
+            (hook_id, board_id) = self.hook_map[ctx.text]
         except KeyError:
             ctx.send_message(messages.FORGET_NOBOARD)
             return False
 
-        hook.delete_instance()
+        models.BoardHook.delete().where(models.BoardHook.id == hook_id).execute()
+        ctx.base_bot.routes.remove_hook(ctx.chat_id, board_id)
+        ctx.base_bot.reconciler.schedule(ctx.session.trello_token)
         ctx.send_message(messages.FORGET_SUCCESS)
         return True
 
@@ -89,6 +139,131 @@ class ForgetHookDialog(Dialog):
         return True
 
 
+def _toggle_options(items, checked):
+    options = []
+    for (id, name) in items:
+        if id in checked:
+            options.append(messages.FILTER_CHECKED.format(name))
+        else:
+            options.append(messages.FILTER_UNCHECKED.format(name))
+
+    options.append(messages.FILTER_DONE)
+    return options
+
+
+def _toggle(ctx: Context, items, checked):
+    """
+    Toggles the item chosen in the message.
+    Returns True, if the choice is done.
+    """
+    if ctx.text == messages.FILTER_DONE:
+        return True
+
+    for (id, name) in items:
+        if ctx.text in (messages.FILTER_CHECKED.format(name),
+                        messages.FILTER_UNCHECKED.format(name)):
+            checked ^= {id}
+            return False
+
+    ctx.send_message(messages.FILTER_NOOPTION)
+    return False
+
+
+class FilterHookDialog(Dialog):
+    def __init__(self, hook_map):
+        self.hook_map = hook_map # Board name -> (hook id, board id)
+        self.hook_options = list(self.hook_map.keys())
+
+        self.hook_id = None
+        self.board_id = None
+        self.board_lists = [] # List of (id, name)
+        self.board_members = [] # List of (id, name)
+
+        self.events = set()
+        self.list_ids = set()
+        self.member_ids = set()
+
+        super().__init__()
+
+    def step1(self, ctx: Context):
+        try:
+            (self.hook_id, self.board_id) = self.hook_map[ctx.text]
+        except KeyError:
+            ctx.send_message(messages.FILTER_NOBOARD)
+            return False
+
+        route = ctx.base_bot.routes.get(ctx.chat_id, self.board_id)
+        if route is None:
+            # The hook was removed since the dialog started.
+            ctx.send_message(messages.FILTER_NOBOARD)
+            return False
+
+        board = trello.Board(ctx.trello_session, self.board_id, ctx.text, None)
+        self.board_lists = [(l.id, l.name) for l in board.lists()]
+        self.board_members = [(m.id, m.fullname) for m in board.members()]
+
+        current = route.subscription
+        self.events = {e for (e, _) in subscriptions.EVENT_NAMES if current.wants(e)}
+        self.list_ids = set(current.list_ids)
+        self.member_ids = set(current.member_ids)
+        return True
+
+    step1_message = messages.FILTER_DLG_MSG
+
+    @property
+    def step1_options(self):
+        return self.hook_options
+
+    def step2(self, ctx: Context):
+        return _toggle(ctx, subscriptions.EVENT_NAMES, self.events)
+
+    step2_message = messages.FILTER_EVENTS_MSG
+
+    @property
+    def step2_options(self):
+        return _toggle_options(subscriptions.EVENT_NAMES, self.events)
+
+    def step3(self, ctx: Context):
+        return _toggle(ctx, self.board_lists, self.list_ids)
+
+    step3_message = messages.FILTER_LISTS_MSG
+
+    @property
+    def step3_options(self):
+        return _toggle_options(self.board_lists, self.list_ids)
+
+    def step4(self, ctx: Context):
+        if not _toggle(ctx, self.board_members, self.member_ids):
+            return False
+
+        if len(self.events) == len(subscriptions.EVENT_NAMES):
+            mask = subscriptions.ALL_EVENTS
+        else:
+            mask = sum(self.events)
+
+        # Lists and members might have been removed from the board since.
+        list_ids = self.list_ids & {id for (id, _) in self.board_lists}
+        member_ids = self.member_ids & {id for (id, _) in self.board_members}
+
+        subscription = subscriptions.Subscription(mask, list_ids, member_ids)
+        models.BoardHook.update(**subscription.to_columns()).where(
+            models.BoardHook.id == self.hook_id).execute()
+        ctx.base_bot.routes.set_subscription(ctx.chat_id, self.board_id, subscription)
+
+        ctx.send_message(messages.FILTER_SUCCESS)
+        return True
+
+    step4_message = messages.FILTER_MEMBERS_MSG
+
+    @property
+    def step4_options(self):
+        return _toggle_options(self.board_members, self.member_ids)
+
+    def cancel(self, ctx: Context):
+        ctx.send_message(messages.FILTER_CANCELLED)
+        return True
+
+
 def require_auth(fn):
     def wrapper(self, ctx, *args, **kwargs):
         if not ctx.session.trello_token:
@@ -125,29 +300,69 @@ class TrelloBot(BaseBot):
     def __init__(self, telegram_key: str, trello_key: trello.App):
         logger.debug("Create new instance of TrelloBot.")
         logger.debug("...Init BaseBot.")
-        super().__init__(telegram_key)
+        super().__init__(telegram_key,
+                         sender_workers=getattr(config, 'TELEGRAM_SENDER_WORKERS', 4),
+                         dialogs_max=getattr(config, 'DIALOGS_MAX', 1000),
+                         dialog_ttl=getattr(config, 'DIALOG_TTL', 600))
 
         logger.debug("...Init trello.App.")
-        self.trello_app = trello.App(trello_key)
+        self.trello_app = trello.App(
+            trello_key,
+            pool_size=getattr(config, 'TRELLO_POOL_SIZE', 10),
+            timeout=getattr(config, 'TRELLO_TIMEOUT', (5, 30)),
+            member_cache_size=getattr(config, 'MEMBER_CACHE_SIZE', 4096),
+            member_cache_ttl=getattr(config, 'MEMBER_CACHE_TTL', 3600),
+            metadata_cache_size=getattr(config, 'METADATA_CACHE_SIZE', 4096),
+            metadata_cache_ttl=getattr(config, 'METADATA_CACHE_TTL', 600),
+            key_rate_limit=getattr(config, 'TRELLO_KEY_RATE_LIMIT', 300),
+            token_rate_limit=getattr(config, 'TRELLO_TOKEN_RATE_LIMIT', 100),
+            rate_limit_retries=getattr(config, 'TRELLO_RATE_LIMIT_RETRIES', 3))
+
+        if trello_async.aiohttp is not None:
+            logger.debug("...Init trello_async.AsyncClient.")
+            self.trello_async = trello_async.AsyncClient(
+                self.trello_app,
+                limit=getattr(config, 'TRELLO_ASYNC_LIMIT', 10),
+                timeout=getattr(config, 'TRELLO_TIMEOUT', (5, 30)))
+        else:
+            self.trello_async = None
+
+        logger.debug("...Load routing table.")
+        self.routes = routing.RoutingTable()
+        self.routes.load()
 
         logger.debug("...Init trello_wh.WebhookReciever.")
         self.wh_reciever = trello_wh.WebhookReciever(
             self, config.TRELLO_WH_HOST, config.TRELLO_WH_PORT)
 
+        logger.debug("...Init reconciler.WebhookReconciler.")
+        self.reconciler = reconciler.WebhookReconciler(
+            self,
+            interval=getattr(config, 'RECONCILE_INTERVAL', 60),
+            batch_size=getattr(config, 'RECONCILE_BATCH', 5))
+
     def run(self):
         logger.info("Run the TrelloBot.")
+        telegram_url = self.wh_reciever.telegram_callback_url()
         logger.debug("...Start WebhookReciever.")
         self.wh_reciever.start()
-        logger.debug("...Run the BaseBot.")
-        super().run()
-
-    def send_message(self, chat_id: int, text: str, *args, **kwargs):
-        try:
-            super().send_message(chat_id, text, *args, **kwargs)
-        except Exception as e:
-            logger.error(
-                "Message sending to chat id {} failed: {}. Message text: {}; other params: {}, {}.".format(
-                    chat_id, repr(e), repr(text), repr(args), repr(kwargs)))
+        logger.debug("...Start WebhookReconciler.")
+        self.reconciler.start()
+        if telegram_url:
+            logger.debug("...Run the BaseBot with Telegram webhook.")
+        else:
+            logger.debug("...Run the BaseBot with long polling.")
+        super().run(webhook_url=telegram_url)
+
+    def dialog_expired(self, chat_id: int, dialog: Dialog):
+        logger.debug("Dialog {} expired in chat {}.".format(
+            type(dialog).__name__, chat_id))
+        self.send_message(chat_id, messages.DIALOG_EXPIRED)
+
+    def send_failed(self, chat_id: int, params: Dict[str, Any], error: Exception):
+        logger.error(
+            "Message sending to chat id {} failed: {}. Message params: {}.".format(
+                chat_id, repr(error), repr(params)))
 
     def wrap_context(self, ctx: Context):
         (ctx.session, _) = models.Session.get_or_create(chat_id=ctx.chat_id)
@@ -193,6 +408,7 @@ class TrelloBot(BaseBot):
         ctx.session.trello_token = token
         ctx.session.admin_id = ctx.message.from_user.id
         ctx.session.save()
+        self.routes.set_token(ctx.chat_id, token)
 
         msg = messages.AUTH_SUCCESS.format(fullname=me.fullname)
         ctx.send_message(msg)
@@ -217,6 +433,7 @@ class TrelloBot(BaseBot):
             ctx.session.trello_token = private_session.trello_token
             ctx.session.admin_id = ctx.message.from_user.id
             ctx.session.save()
+            self.routes.set_token(ctx.chat_id, private_session.trello_token)
 
             msg = messages.AUTH_SUCCESS.format(fullname=me.fullname)
             ctx.send_message(msg)
@@ -279,6 +496,9 @@ class TrelloBot(BaseBot):
             models.BoardHook.session == ctx.session).execute()
         logger.debug("...Delete chat session.")
         ctx.session.delete_instance()
+        self.routes.remove_chat(ctx.chat_id)
+        # Webhooks of the token are removed, unless other chats still use them.
+        self.reconciler.schedule(ctx.session.trello_token)
         ctx.send_message(messages.UNAUTH_SUCCESS)
 
     @require_auth
@@ -290,26 +510,43 @@ class TrelloBot(BaseBot):
         logger.debug("...Found {} boards.".format(len(boards)))
         self._start_dialog_logged(ctx, AddHookDialog(boards))
 
-    @require_auth
-    def cmd_list(self, ctx: Context):
-        self._log_command(ctx, "list")
-
+    def _load_hooked_boards(self, ctx: Context):
+        """
+        Returns (hook, board) pairs of the chat's hooks.
+        Hooks of boards which could not be loaded are deleted.
+        """
         hooks = ctx.session.hooks.execute()
         logger.debug("...Found {} hooks.".format(len(hooks)))
 
-        hooks_msgs = []
+        board_ids = [h.board_id for h in hooks]
+        if self.trello_async:
+            # Boards missing from the cache are batched, chunks sent concurrently.
+            session = self.trello_async.session(ctx.session.trello_token)
+            boards = self.trello_async.run(session.boards.get_many(board_ids))
+        else:
+            boards = ctx.trello_session.boards.get_many(board_ids)
+        logger.debug("...Loaded {} boards.".format(len(boards)))
+
+        hooked_boards = []
         for h in hooks:
             try:
-                b = ctx.trello_session.boards.get(h.board_id)
-                bname = b.name
-            except trello.NotFoundError:
+                hooked_boards.append((h, boards[h.board_id]))
+            except KeyError:
                 logger.warn(
                     "...Could not load board {} for hook {}. Deleting it.".format(
                         h.board_id, h.id))
-                h.delete()
-                continue
+                h.delete_instance()
+                self.routes.remove_hook(ctx.chat_id, h.board_id)
+
+        return hooked_boards
 
-            msg = messages.LIST_ITEM.format(board=bname)
+    @require_auth
+    def cmd_list(self, ctx: Context):
+        self._log_command(ctx, "list")
+
+        hooks_msgs = []
+        for (h, b) in self._load_hooked_boards(ctx):
+            msg = messages.LIST_ITEM.format(board=b.name)
             hooks_msgs.append(msg)
 
         logger.debug(
@@ -322,23 +559,16 @@ class TrelloBot(BaseBot):
     def cmd_forget(self, ctx: Context):
         self._log_command(ctx, "forget")
 
-        hooks = ctx.session.hooks.execute()
-        logger.debug("...Found {} hooks.".format(len(hooks)))
-
-        hook_map = {}
-        for h in hooks:
-            try:
-                b = ctx.trello_session.boards.get(h.board_id)
-            except trello.NotFoundError:
-                logger.warn(
-                    "...Could not load board {} for hook {}. Deleting it.".format(
-                        h.board_id, h.id))
-                h.delete()
-                continue
+        hook_map = {b.name: (h.id, b.id) for (h, b) in self._load_hooked_boards(ctx)}
+        self._start_dialog_logged(ctx, ForgetHookDialog(hook_map))
 
-            hook_map[b.name] = h
+    @require_auth
+    @require_admin
+    def cmd_filter(self, ctx: Context):
+        self._log_command(ctx, "filter")
 
-        self._start_dialog_logged(ctx, ForgetHookDialog(hook_map))
+        hook_map = {b.name: (h.id, b.id) for (h, b) in self._load_hooked_boards(ctx)}
+        self._start_dialog_logged(ctx, FilterHookDialog(hook_map))
 
     def cmd_dev(self, ctx: Context):
         self._log_command(ctx, "dev")
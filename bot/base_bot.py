@@ -1,8 +1,14 @@
+import time
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+
 from telegram import Bot, Update
 from telegram.ext import CommandHandler, Filters, MessageHandler, Updater
 
 from typing import *
 
+from bot.sender import OutboundSender
+
 
 class Context:
     def __init__(self, base_bot, bot: Bot, update: Update, args: List[str]=None):
@@ -93,14 +99,113 @@ class Dialog:
         return False
 
 
+class DialogStore:
+    """
+    Dialogs by chat id. Dialogs idle for longer than `ttl` seconds and
+    the least recently used ones past `maxsize` are evicted, calling
+    `on_evict(chat_id, dialog)`.
+    """
+
+    def __init__(self, maxsize: int=1000, ttl: float=600, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+
+        self._dialogs = OrderedDict() # chat id -> (last use, dialog), least recent first
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    def _evicted(self, evicted):
+        if self.on_evict is None:
+            return
+        for (chat_id, dialog) in evicted:
+            self.on_evict(chat_id, dialog)
+
+    def get(self, chat_id):
+        evicted = []
+        with self._lock:
+            try:
+                (last_use, dialog) = self._dialogs[chat_id]
+            except KeyError:
+                return None
+
+            if last_use + self.ttl < time.monotonic():
+                del self._dialogs[chat_id]
+                evicted.append((chat_id, dialog))
+                dialog = None
+            else:
+                self._dialogs[chat_id] = (time.monotonic(), dialog)
+                self._dialogs.move_to_end(chat_id)
+
+        self._evicted(evicted)
+        return dialog
+
+    def put(self, chat_id, dialog):
+        evicted = []
+        with self._lock:
+            self._dialogs[chat_id] = (time.monotonic(), dialog)
+            self._dialogs.move_to_end(chat_id)
+
+            while len(self._dialogs) > self.maxsize:
+                evicted.append(self._dialogs.popitem(last=False))
+
+        self._evicted((chat_id, d) for (chat_id, (_, d)) in evicted)
+
+    def pop(self, chat_id):
+        with self._lock:
+            (_, dialog) = self._dialogs.pop(chat_id, (None, None))
+            return dialog
+
+    def sweep(self):
+        """
+        Evicts the expired dialogs. They are ordered by last use,
+        so only the expired ones and one more are looked at.
+        """
+        deadline = time.monotonic() - self.ttl
+        evicted = []
+        with self._lock:
+            while self._dialogs:
+                (chat_id, (last_use, dialog)) = next(iter(self._dialogs.items()))
+                if last_use >= deadline:
+                    break
+                del self._dialogs[chat_id]
+                evicted.append((chat_id, dialog))
+
+        self._evicted(evicted)
+
+    def _loop(self, interval):
+        while not self._stop.wait(interval):
+            self.sweep()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = Thread(target=self._loop, args=(min(self.ttl, 60),), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def __len__(self):
+        return len(self._dialogs)
+
+
 class BaseBot:
-    def __init__(self, key: str):
+    def __init__(self, key: str, *, sender_workers: int=4,
+                 dialogs_max: int=1000, dialog_ttl: float=600):
         self._key = key
         self.bot = Bot(token=key)
         self.updater = Updater(bot=self.bot)
         self.dispatcher = self.updater.dispatcher
+        self.sender = OutboundSender(self._deliver_message,
+                                     workers=sender_workers,
+                                     on_failure=self.send_failed)
 
-        self.dialogs = {}
+        self.dialogs = DialogStore(maxsize=dialogs_max, ttl=dialog_ttl,
+                                   on_evict=self.dialog_expired)
 
     def wrap_context(self, ctx: Context):
         return ctx
@@ -114,15 +219,15 @@ class BaseBot:
         return wrapper
 
     def cmd_cancel(self, ctx: Context):
-        try:
-            dialog = self.dialogs[ctx.chat_id]
-            if dialog.cancel(ctx):
-                del self.dialogs[ctx.chat_id]
-        except KeyError:
-            pass
+        dialog = self.dialogs.get(ctx.chat_id)
+        if dialog is not None and dialog.cancel(ctx):
+            self.dialogs.pop(ctx.chat_id)
 
     def _start_dialog_for(self, chat_id, dialog):
-        self.dialogs[chat_id] = dialog
+        self.dialogs.put(chat_id, dialog)
+
+    def dialog_expired(self, chat_id: int, dialog: Dialog):
+        pass
 
     def _options_to_reply_markup(self, options: List[List[str]]):
         keyboard = []
@@ -140,17 +245,25 @@ class BaseBot:
 
     def send_message(self, chat_id: int, text: str, *,
                      options: List[List[str]]=None,
-                     reply_to: int=None):
+                     reply_to: int=None,
+                     on_sent=None):
         if options:
             reply_markup = self._options_to_reply_markup(options)
         else:
             reply_markup = {'hide_keyboard': True}
 
-        self.bot.send_message(chat_id=chat_id,
-                              text=text,
-                              parse_mode="Markdown",
-                              reply_markup=reply_markup,
-                              reply_to_message_id=reply_to)
+        self.sender.submit(chat_id,
+                           on_done=on_sent,
+                           text=text,
+                           parse_mode="Markdown",
+                           reply_markup=reply_markup,
+                           reply_to_message_id=reply_to)
+
+    def _deliver_message(self, chat_id: int, **kwargs):
+        self.bot.send_message(chat_id=chat_id, **kwargs)
+
+    def send_failed(self, chat_id: int, params: Dict[str, Any], error: Exception):
+        pass
 
     def msg(self, ctx: Context):
         pass
@@ -159,11 +272,10 @@ class BaseBot:
         ctx = Context(self, bot, update)
         ctx = self.wrap_context(ctx)
 
-        if ctx.chat_id in self.dialogs:
-            dialog = self.dialogs[ctx.chat_id]
-
+        dialog = self.dialogs.get(ctx.chat_id)
+        if dialog is not None:
             if dialog.progress(ctx):
-                del self.dialogs[ctx.chat_id]
+                self.dialogs.pop(ctx.chat_id)
 
             return
 
@@ -172,7 +284,20 @@ class BaseBot:
     def _error_handler(self, bot: Bot, update: Update, error):
         raise error
 
-    def run(self):
+    def process_update(self, data: Dict[str, Any]):
+        """
+        Dispatches an update received through the Telegram webhook.
+        """
+        self.updater.update_queue.put(Update.de_json(data, self.bot))
+
+    def run(self, webhook_url: str=None):
+        """
+        Receives updates through the webhook at `webhook_url`, which must
+        pass them to process_update, or with long polling if it's None.
+        """
+        self.sender.start()
+        self.dialogs.start()
+
         for key in dir(self):
             if not key.startswith('cmd_'): continue
 
@@ -185,4 +310,10 @@ class BaseBot:
         self.dispatcher.add_error_handler(self._error_handler)
         self.dispatcher.add_handler(MessageHandler([Filters.text], self._msg_handler))
 
-        self.updater.start_polling()
+        if webhook_url:
+            Thread(target=self.dispatcher.start, name='dispatcher').start()
+            self.bot.set_webhook(webhook_url=webhook_url)
+        else:
+            # Telegram refuses to return updates while a webhook is set.
+            self.bot.set_webhook(webhook_url='')
+            self.updater.start_polling()
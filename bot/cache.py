@@ -0,0 +1,123 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class TTLCache:
+    """
+    Thread-safe mapping, evicting least recently used entries past `maxsize`
+    and entries older than `ttl` seconds.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._data = OrderedDict() # key -> (expires_at, value)
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                (expires_at, value) = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires_at < time.monotonic():
+                self._discard(key)
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._discard(next(iter(self._data)))
+
+    def _discard(self, key):
+        self._data.pop(key, None)
+
+    def items(self):
+        now = time.monotonic()
+        with self._lock:
+            return [(k, v) for (k, (expires_at, v)) in self._data.items()
+                    if expires_at >= now]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+
+class TaggedCache(TTLCache):
+    """
+    TTLCache whose entries can be tagged, to invalidate every entry
+    with a tag at once.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize, ttl)
+        self._keys_by_tag = {} # tag -> set of keys
+        self._tags_by_key = {} # key -> tags
+
+    def put(self, key, value, tags=()):
+        with self._lock:
+            self._untag(key)
+            tags = frozenset(tags)
+            if tags:
+                self._tags_by_key[key] = tags
+                for tag in tags:
+                    self._keys_by_tag.setdefault(tag, set()).add(key)
+
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._discard(next(iter(self._data)))
+
+    def _discard(self, key):
+        super()._discard(key)
+        self._untag(key)
+
+    def _untag(self, key):
+        for tag in self._tags_by_key.pop(key, ()):
+            keys = self._keys_by_tag[tag]
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_tag[tag]
+
+    def invalidate_tag(self, tag):
+        with self._lock:
+            for key in list(self._keys_by_tag.get(tag, ())):
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._keys_by_tag.clear()
+            self._tags_by_key.clear()
@@ -0,0 +1,95 @@
+import copy
+from typing import *
+
+from bot.records import ActionRecord
+
+
+def _move_key(a):
+    if a.type == 'updateCard' and a.changed_field == 'idList':
+        return ('move', a.card_id)
+    return None
+
+
+def _member_key(a):
+    if a.type in ('addMemberToCard', 'removeMemberFromCard'):
+        return ('member', a.card_id, a.member_id)
+    return None
+
+
+def _comment_key(a):
+    if a.type == 'commentCard':
+        return ('comment', a.card_id, a.id_member_creator)
+    return None
+
+
+def coalesce(actions: List[ActionRecord]) -> List[ActionRecord]:
+    """
+    Reduces the actions of a debounce window to the changes they make:
+
+    * repeated deliveries of an action are dropped;
+    * chains of moves of a card become a single move from the first list
+      to the last one, or nothing, if the card is back in its list;
+    * adding and removing the same member of a card cancel each other;
+    * comments of a user on a card are merged into one.
+
+    The result is ordered by the first action of every change.
+    """
+    result = [] # List of records, None for the removed ones
+    slots = {} # key -> index in result
+    seen_ids = set()
+
+    for a in actions:
+        if a.id in seen_ids:
+            continue
+        seen_ids.add(a.id)
+
+        key = _move_key(a)
+        if key is not None:
+            i = slots.get(key)
+            if i is None:
+                slots[key] = len(result)
+                result.append(a)
+                continue
+
+            first = result[i]
+            if first is None:
+                # The moves so far have cancelled out.
+                result[i] = a
+                continue
+
+            merged = copy.copy(a)
+            merged.message = None
+            merged.list_before_id = first.list_before_id
+            merged.list_before_name = first.list_before_name
+            result[i] = None if merged.list_before_id == merged.list_after_id else merged
+            continue
+
+        key = _member_key(a)
+        if key is not None:
+            i = slots.get(key)
+            if i is not None and result[i] is not None and result[i].type != a.type:
+                result[i] = None
+                del slots[key]
+                continue
+
+            slots[key] = len(result)
+            result.append(a)
+            continue
+
+        key = _comment_key(a)
+        if key is not None:
+            i = slots.get(key)
+            if i is not None:
+                merged = copy.copy(result[i])
+                merged.message = None
+                merged.text = merged.text + "\n\n" + a.text
+                result[i] = merged
+                continue
+
+            slots[key] = len(result)
+            result.append(a)
+            continue
+
+        result.append(a)
+
+    return [a for a in result if a is not None]
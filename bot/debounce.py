@@ -0,0 +1,65 @@
+import math
+from threading import Lock
+
+from bot.cache import TTLCache
+
+
+class AdaptiveDebounce:
+    """
+    Debounce windows of message queues, adapted to the event rate of every
+    (chat, board) pair. The rate is an exponentially weighted moving
+    average with time constant `tau` seconds.
+
+    A lone event waits `min_lag` seconds; the window stretches towards
+    `max_lag` as the rate grows, reaching the middle at `half_rate` events
+    per second. No event waits longer than `max_wait` seconds.
+    """
+
+    def __init__(self, min_lag: float, max_lag: float, max_wait: float,
+                 half_rate: float, tau: float=60):
+        self.min_lag = min_lag
+        self.max_lag = max_lag
+        self.max_wait = max_wait
+        self.half_rate = half_rate
+        self.tau = tau
+
+        # The rate of an idle pair decays below 1% in 5 time constants.
+        self._rates = TTLCache(maxsize=100000, ttl=tau * 5) # key -> (rate, time)
+        self._lock = Lock()
+
+    def _decayed(self, rate, since, now):
+        return rate * math.exp(-(now - since) / self.tau)
+
+    def window(self, rate: float) -> float:
+        return self.min_lag + (self.max_lag - self.min_lag) * rate / (rate + self.half_rate)
+
+    def record(self, key, now: float) -> float:
+        """
+        Records an event and returns the debounce window following it.
+        """
+        with self._lock:
+            (rate, since) = self._rates.get(key, (0.0, now))
+            rate = self._decayed(rate, since, now) + 1 / self.tau
+            self._rates.put(key, (rate, now))
+
+        return self.window(rate)
+
+    def deadline(self, window: float, last_event: float, first_event: float) -> float:
+        return min(last_event + window, first_event + self.max_wait)
+
+    def stats(self, now: float):
+        """
+        Returns aggregates of the current windows. Chat and board ids are
+        left out, so they are not exposed by the stats endpoint.
+        """
+        windows = sorted(self.window(self._decayed(rate, since, now))
+                         for (rate, since) in (v for (_, v) in self._rates.items()))
+        if not windows:
+            return {'count': 0}
+
+        return {
+            'count': len(windows),
+            'min': windows[0],
+            'median': windows[len(windows) // 2],
+            'max': windows[-1],
+        }
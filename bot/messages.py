@@ -6,6 +6,8 @@ MUST_AUTH = "Этот чат неавторизован. Используйте
 
 FORBIDDEN = "Эту команду может использовать только владелец аккаунта Trello."
 
+DIALOG_EXPIRED = "Время ожидания ответа истекло. Чтобы продолжить, повторите команду."
+
 #
 # /start
 #
@@ -69,7 +71,16 @@ UNAUTH_SUCCESS = """
 
 NOTIFY_DLG_MSG = "Выберите доску, по которой хотите получать уведомления:"
 
-NOTIFY_NOBOARD = "Такой доски нет, пожалуйсте выберите одну из представленных досок."
+NOTIFY_SEARCH_MSG = """
+Выберите доску, по которой хотите получать уведомления, или отправьте начало её названия для поиска.
+Страница {page} из {pages}.
+"""
+
+NOTIFY_NOTFOUND = "Досок, название которых начинается с «{}», нет."
+
+NOTIFY_PREV = "« Назад"
+
+NOTIFY_NEXT = "Далее »"
 
 NOTIFY_ALREADY = "По этой доске уведомления уже подключены."
 
@@ -101,6 +112,48 @@ FORGET_SUCCESS = "Уведомления по доске успешно откл
 
 FORGET_CANCELLED = "Отключение доски отменено."
 
+#
+# /filter
+#
+
+FILTER_DLG_MSG = "Выберите доску, уведомления по которой хотите настроить:"
+
+FILTER_NOBOARD = "Такой доски нет, пожалуйсте выберите одну из представленных досок."
+
+FILTER_EVENTS_MSG = "Выберите события, о которых следует уведомлять, и нажмите «Готово»."
+
+FILTER_LISTS_MSG = """
+Выберите списки, события в которых следует отслеживать, и нажмите «Готово».
+Если не выбран ни один список, отслеживаются все.
+"""
+
+FILTER_MEMBERS_MSG = """
+Выберите участников, о действиях которых следует уведомлять, и нажмите «Готово».
+Если не выбран ни один участник, уведомления приходят о действиях всех.
+"""
+
+FILTER_NOOPTION = "Такого варианта нет, пожалуйста выберите один из представленных."
+
+FILTER_DONE = "Готово"
+
+FILTER_CHECKED = "✅ {}"
+
+FILTER_UNCHECKED = "⬜ {}"
+
+FILTER_EVENT_CREATED = "Новые карточки"
+
+FILTER_EVENT_MOVED = "Перемещения карточек"
+
+FILTER_EVENT_ARCHIVED = "Архивирование карточек"
+
+FILTER_EVENT_COMMENTED = "Комментарии"
+
+FILTER_EVENT_MEMBERS = "Участники карточек"
+
+FILTER_SUCCESS = "Настройки уведомлений по доске сохранены."
+
+FILTER_CANCELLED = "Настройка уведомлений отменена."
+
 #
 # /dev
 #
@@ -123,6 +176,7 @@ HELP = """
 /status - Статус авторизации
 /notify - Подключить доску +
 /forget - Отключить доску +
+/filter - Настроить уведомления по доске +
 /list - Список подключенных досок
 /help - Помощь
 /cancel - Отменить текущее действие
@@ -140,6 +194,8 @@ HOOK_WRAP = """
 {message}
 """
 
+HOOK_MORE = "_…и ещё изменений: {count}_"
+
 HOOK_CARD_CREATED = """
 *{user_name}* добавил
 💳[{card_text}]({card_url})
@@ -4,7 +4,8 @@ import peewee
 
 import config
 
-db = peewee.SqliteDatabase(None, threadlocals=True)
+db = peewee.SqliteDatabase(None, threadlocals=True,
+                           pragmas=(('synchronous', 'normal'),))
 
 
 class BaseModel(peewee.Model):
@@ -22,8 +23,65 @@ class BoardHook(BaseModel):
     session = peewee.ForeignKeyField(Session, related_name='hooks')
     board_id = peewee.CharField()
 
+    # Subscription settings, see bot.subscriptions
+    event_mask = peewee.IntegerField(default=-1)
+    list_ids = peewee.TextField(default='')
+    member_ids = peewee.TextField(default='')
+
+    class Meta:
+        indexes = (
+            (('session', 'board_id'), True),
+        )
+
+
+class OutboxMessage(BaseModel):
+    """
+    Notification waiting to be sent, so that it survives a restart.
+    Rows are only ever inserted and deleted once acknowledged.
+    """
+    id = peewee.IntegerField(primary_key=True)
+    chat_id = peewee.IntegerField()
+    board_id = peewee.CharField()
+    board_name = peewee.CharField()
+    board_short_link = peewee.CharField(null=True)
+    # records.ActionRecord serialized to json
+    action = peewee.TextField()
+
+    class Meta:
+        indexes = (
+            (('chat_id', 'board_id'), False),
+        )
+
+
+def _add_column(table, column, definition):
+    columns = [row[1] for row in db.execute_sql(
+        "PRAGMA table_info({})".format(table)).fetchall()]
+    if column not in columns:
+        db.execute_sql("ALTER TABLE {} ADD COLUMN {} {}".format(
+            table, column, definition))
+
+
+def migrate():
+    db.execute_sql("PRAGMA journal_mode=WAL")
+    db.create_tables([OutboxMessage], safe=True)
+
+    _add_column('boardhook', 'event_mask', "INTEGER NOT NULL DEFAULT -1")
+    _add_column('boardhook', 'list_ids', "TEXT NOT NULL DEFAULT ''")
+    _add_column('boardhook', 'member_ids', "TEXT NOT NULL DEFAULT ''")
+
+    # Databases created before the unique index was added may contain
+    # duplicate hooks, which would make the index creation fail.
+    db.execute_sql(
+        "DELETE FROM boardhook WHERE id NOT IN "
+        "(SELECT MIN(id) FROM boardhook GROUP BY session_id, board_id)")
+    db.execute_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS boardhook_session_id_board_id "
+        "ON boardhook (session_id, board_id)")
+
 
 db.init(config.DB_FILE)
 
 if not os.path.isfile(config.DB_FILE):
-    db.create_tables([Session, BoardHook])
+    db.create_tables([Session, BoardHook, OutboxMessage])
+
+migrate()
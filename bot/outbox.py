@@ -0,0 +1,114 @@
+import itertools
+import logging
+from collections import namedtuple
+from threading import Event, Lock, Thread
+
+import peewee
+
+from bot.models import OutboxMessage, db
+
+logger = logging.getLogger(__name__)
+
+INSERT_CHUNK = 100
+
+OutboxRow = namedtuple('OutboxRow', ['id', 'chat_id', 'board_id', 'board_name',
+                                     'board_short_link', 'action'])
+
+
+class Outbox:
+    """
+    Durable log of pending notifications.
+
+    Appended rows are buffered in memory and written in batches, either
+    periodically or together with the next acknowledgement, so that a
+    burst of events costs a single transaction.
+    """
+
+    def __init__(self, write_interval: float=1):
+        self.write_interval = write_interval
+
+        self._buffer = [] # List of OutboxRow, not written yet
+        self._lock = Lock()
+        self._ids = None
+        self._stop = Event()
+        self._thread = None
+
+    def _next_id(self):
+        with self._lock:
+            if self._ids is None:
+                last_id = OutboxMessage.select(peewee.fn.MAX(OutboxMessage.id)).scalar()
+                self._ids = itertools.count((last_id or 0) + 1)
+            return next(self._ids)
+
+    def append(self, chat_id: int, board, action: str) -> int:
+        row = OutboxRow(self._next_id(), chat_id, board.id, board.name,
+                        board.short_link, action)
+        with self._lock:
+            self._buffer.append(row)
+        return row.id
+
+    def _commit(self, rows, delete_query=None):
+        try:
+            with db.atomic():
+                # Keep within SQLite's limit of variables per statement.
+                for i in range(0, len(rows), INSERT_CHUNK):
+                    chunk = rows[i:i + INSERT_CHUNK]
+                    OutboxMessage.insert_many([r._asdict() for r in chunk]).execute()
+                if delete_query is not None:
+                    delete_query.execute()
+        except Exception:
+            # Put the rows back, they will be written with the next batch.
+            with self._lock:
+                self._buffer[:0] = rows
+            raise
+
+    def write(self):
+        with self._lock:
+            rows = self._buffer
+            self._buffer = []
+
+        if rows:
+            self._commit(rows)
+
+    def ack(self, chat_id: int, board_id: str, up_to_id: int):
+        """
+        Removes notifications of a chat and board up to the given id.
+        """
+        with self._lock:
+            rows = [r for r in self._buffer
+                    if not (r.chat_id == chat_id and
+                            r.board_id == board_id and
+                            r.id <= up_to_id)]
+            self._buffer = []
+
+        self._commit(rows, OutboxMessage.delete().where(
+            (OutboxMessage.chat_id == chat_id) &
+            (OutboxMessage.board_id == board_id) &
+            (OutboxMessage.id <= up_to_id)))
+
+    def pending(self):
+        self.write()
+        query = OutboxMessage.select(
+            OutboxMessage.id, OutboxMessage.chat_id, OutboxMessage.board_id,
+            OutboxMessage.board_name, OutboxMessage.board_short_link,
+            OutboxMessage.action).order_by(OutboxMessage.id)
+        return [OutboxRow(*t) for t in query.tuples()]
+
+    def _loop(self):
+        while not self._stop.wait(self.write_interval):
+            try:
+                self.write()
+            except Exception as e:
+                logger.error("Could not write the outbox: {}.".format(repr(e)))
+
+    def start(self):
+        self._stop.clear()
+        self._thread = Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.write()
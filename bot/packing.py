@@ -0,0 +1,152 @@
+from typing import *
+
+# Maximum length of a Telegram message text
+MESSAGE_LIMIT = 4096
+
+ITEM_SEPARATOR = "\n\n"
+
+
+def text_length(text: str) -> int:
+    # Telegram counts message length in UTF-16 code units.
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _char_length(c: str) -> int:
+    return 2 if ord(c) > 0xFFFF else 1
+
+
+def _safe_cut(text: str, limit: int) -> int:
+    """
+    Returns the largest index, not longer than `limit` UTF-16 units,
+    at which `text` can be cut without breaking a Markdown entity.
+    Whitespace is preferred as a cutting point.
+    """
+    state = None
+    length = 0
+    last_safe = 0
+    last_space = 0
+    i = 0
+
+    while i < len(text):
+        c = text[i]
+        step = 1
+
+        if state is None:
+            if text.startswith('```', i):
+                state = '```'
+                step = 3
+            elif c in '*_`':
+                state = c
+            elif c == '[':
+                state = '['
+        elif state == '```':
+            if text.startswith('```', i):
+                state = None
+                step = 3
+        elif state == '[':
+            if c == ']':
+                state = '(' if text.startswith('](', i) else None
+        elif state == '(':
+            if c == ')':
+                state = None
+        elif c == state:
+            state = None
+
+        length += sum(_char_length(ch) for ch in text[i:i + step])
+        i += step
+        if length > limit:
+            break
+
+        if state is None:
+            last_safe = i
+            if c.isspace():
+                last_space = i
+
+    if last_safe == len(text):
+        return last_safe
+    if last_space > last_safe // 2:
+        return last_space
+    return last_safe
+
+
+def _strip_markdown(text: str) -> str:
+    for c in ('```', '*', '_', '`', '['):
+        text = text.replace(c, '')
+    return text
+
+
+def _split(text: str, limit: int) -> List[str]:
+    fragments = []
+
+    while text_length(text) > limit:
+        cut = _safe_cut(text, limit)
+        if cut == 0:
+            # A single entity is longer than the limit.
+            # Strip its markup, so that it can be cut anywhere.
+            text = _strip_markdown(text)
+            cut = _safe_cut(text, limit)
+
+        fragments.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+
+    if text:
+        fragments.append(text)
+
+    return fragments
+
+
+def pack(items: List[str], wrap: Callable[[str], str], *,
+         limit: int=MESSAGE_LIMIT, max_parts: int=None,
+         more: str=None) -> List[str]:
+    """
+    Greedily joins items into as few messages as possible, each of them
+    within `limit` after being passed through `wrap`.
+
+    If more than `max_parts` messages would be produced, items which do not
+    fit are replaced with the `more` line, formatted with their `count`.
+    An item cut short by the last part counts as not fitting.
+    """
+    budget = limit - text_length(wrap(''))
+    sep_length = text_length(ITEM_SEPARATOR)
+
+    if more is not None:
+        more_length = sep_length + text_length(more.format(count=len(items)))
+    else:
+        more_length = 0
+
+    parts = []
+    current = []
+    current_length = 0
+    skipped = 0
+
+    for (n, item) in enumerate(items):
+        fragments = _split(item.strip(), budget - more_length)
+
+        for (k, fragment) in enumerate(fragments):
+            length = text_length(fragment)
+            is_last_part = max_parts is not None and len(parts) == max_parts - 1
+
+            extra = sep_length if current else 0
+            reserved = more_length if is_last_part else 0
+            if current and current_length + extra + length + reserved > budget:
+                if is_last_part:
+                    skipped = len(items) - n
+                    break
+
+                parts.append(current)
+                current = []
+                current_length = 0
+                extra = 0
+
+            current.append(fragment)
+            current_length += extra + length
+        else:
+            continue
+        break
+
+    if skipped and more is not None:
+        current.append(more.format(count=skipped))
+    if current:
+        parts.append(current)
+
+    return [wrap(ITEM_SEPARATOR.join(p)) for p in parts]
@@ -0,0 +1,157 @@
+import logging
+from collections import deque
+from threading import Event, Lock, Thread
+
+from bot import trello
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookReconciler:
+    """
+    Keeps Trello webhooks of every token in line with board hooks:
+    adds missing board webhooks, removes ones no chat needs anymore and
+    replaces per chat webhooks of older versions.
+
+    Every tick either lists the webhooks of a single token or applies at
+    most `batch_size` fixes, so the API is never hit with a burst.
+    """
+
+    def __init__(self, trello_bot, *, interval: float=60, batch_size: int=5):
+        self.bot = trello_bot
+        self.app = trello_bot.trello_app
+        self.reciever = trello_bot.wh_reciever
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self._tokens = deque() # Tokens to check, in order
+        self._fixes = deque() # (token, 'add', board id) or (token, 'delete', webhook)
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+        self.checked = 0
+        self.added = 0
+        self.deleted = 0
+
+    def schedule(self, trello_token: str):
+        """
+        Checks the token with the next tick. Used when hooks of the token
+        change, including tokens which no chat uses anymore.
+        """
+        with self._lock:
+            if trello_token in self._tokens:
+                self._tokens.remove(trello_token)
+            self._tokens.appendleft(trello_token)
+
+    def _next_token(self):
+        with self._lock:
+            if not self._tokens:
+                self._tokens.extend(self.bot.routes.tokens())
+            return self._tokens.popleft() if self._tokens else None
+
+    def _diff(self, trello_token):
+        webhooks = self.app.session(trello_token).webhooks.all()
+        wanted = self.bot.routes.token_boards(trello_token)
+        registered = set()
+        fixes = []
+
+        for wh in webhooks:
+            if self.reciever.is_board_callback_url(wh.callback_url):
+                if (wh.id_model not in registered and
+                        self._is_wanted(trello_token, wh, wanted)):
+                    registered.add(wh.id_model)
+                else:
+                    fixes.append((trello_token, 'delete', wh))
+            elif self.reciever.is_chat_callback_url(wh.callback_url):
+                # Replaced with a board webhook below, if still needed.
+                fixes.append((trello_token, 'delete', wh))
+
+        for board_id in wanted - registered:
+            fixes.append((trello_token, 'add', board_id))
+
+        # Add board webhooks before per chat webhooks are removed.
+        fixes.sort(key=lambda f: f[1] != 'add')
+        return fixes
+
+    def _is_wanted(self, trello_token, wh, wanted):
+        return (wh.id_model in wanted and
+                wh.callback_url == self.reciever.board_callback_url(wh.id_model, trello_token))
+
+    def _apply(self, fix):
+        (trello_token, op, target) = fix
+        wanted = self.bot.routes.token_boards(trello_token)
+
+        if op == 'add':
+            if target not in wanted:
+                return
+            try:
+                self.app.session(trello_token).webhooks.add(
+                    callbackURL=self.reciever.board_callback_url(target, trello_token),
+                    idModel=target)
+            except trello.TrelloError as e:
+                if 'already exists' not in str(e):
+                    raise
+            self.added += 1
+        else:
+            if self._is_wanted(trello_token, target, wanted):
+                return
+            try:
+                target.delete()
+            except trello.NotFoundError:
+                pass
+            self.deleted += 1
+
+    def tick(self):
+        with self._lock:
+            fixes = [self._fixes.popleft()
+                     for _ in range(min(self.batch_size, len(self._fixes)))]
+
+        if not fixes:
+            trello_token = self._next_token()
+            if trello_token is None:
+                return
+
+            fixes = self._diff(trello_token)
+            self.checked += 1
+            if fixes:
+                logger.info("Found {} webhooks to fix.".format(len(fixes)))
+
+            with self._lock:
+                self._fixes.extend(fixes[self.batch_size:])
+            fixes = fixes[:self.batch_size]
+
+        for fix in fixes:
+            try:
+                self._apply(fix)
+            except trello.TrelloError as e:
+                logger.error("Could not fix webhook {}: {}.".format(
+                    repr(fix[1:]), repr(e)))
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error("Webhook reconciliation failed: {}.".format(repr(e)))
+
+    def start(self):
+        self._stop.clear()
+        self._thread = Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'tokens_pending': len(self._tokens),
+                'fixes_pending': len(self._fixes),
+                'checked': self.checked,
+                'added': self.added,
+                'deleted': self.deleted,
+            }
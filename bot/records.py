@@ -0,0 +1,159 @@
+import json
+from collections import namedtuple
+
+CARD_URL = "https://trello.com/c/{}/"
+BOARD_URL = "https://trello.com/b/{}/"
+
+
+class BoardRef(namedtuple('BoardRef', ['id', 'name', 'short_link'])):
+    __slots__ = ()
+
+    @property
+    def url(self):
+        return BOARD_URL.format(self.short_link)
+
+
+def action_kind(d):
+    """
+    Returns the type and the changed field of a raw action.
+    """
+    old = d['data'].get('old')
+    return (d['type'], next(iter(old), None) if old else None)
+
+
+def _cache_member(members_cache, d):
+    members_cache.put(d['id'], (d.get('username'), d.get('fullName'), d.get('url')))
+
+
+class ActionRecord:
+    """
+    Flat record of a webhook action, holding only the fields notifications
+    are rendered from. Unlike trello.Action, it is parsed without building
+    any model objects.
+    """
+
+    __slots__ = (
+        'id', 'type', 'changed_field', 'event',
+        'id_member_creator', 'member_creator_name',
+        'member_id', 'member_name',
+        'board_id', 'board_name', 'board_short_link',
+        'card_id', 'card_name', 'card_short_link',
+        'list_id', 'list_name',
+        'list_before_id', 'list_before_name',
+        'list_after_id', 'list_after_name',
+        'text',
+        'message',
+    )
+
+    def __init__(self, id, type, changed_field, id_member_creator, event=0):
+        self.id = id
+        self.type = type
+        self.changed_field = changed_field
+        self.event = event
+        self.id_member_creator = id_member_creator
+        self.member_creator_name = None
+        self.member_id = None
+        self.member_name = None
+        self.board_id = None
+        self.board_name = None
+        self.board_short_link = None
+        self.card_id = None
+        self.card_name = None
+        self.card_short_link = None
+        self.list_id = None
+        self.list_name = None
+        self.list_before_id = None
+        self.list_before_name = None
+        self.list_after_id = None
+        self.list_after_name = None
+        self.text = None
+        # Rendered notification, shared by every chat the action is sent to
+        self.message = None
+
+    @classmethod
+    def from_payload(cls, d, event_bit=None, members_cache=None):
+        """
+        Parses an action from a webhook payload. `event_bit` maps the action
+        type and changed field to the event bit of the record; actions
+        it maps to 0 are not supported and None is returned for them.
+        """
+        (type, changed_field) = action_kind(d)
+        event = event_bit(type, changed_field) if event_bit is not None else 0
+        if event_bit is not None and not event:
+            return None
+
+        data = d['data']
+        r = cls(d['id'], type, changed_field, d['idMemberCreator'], event)
+
+        board = data.get('board')
+        if board is not None:
+            r.board_id = board['id']
+            r.board_name = board['name']
+            r.board_short_link = board.get('shortLink')
+
+        card = data.get('card')
+        if card is not None:
+            r.card_id = card['id']
+            r.card_name = card['name']
+            r.card_short_link = card.get('shortLink')
+
+        lst = data.get('list')
+        if lst is not None:
+            r.list_id = lst['id']
+            r.list_name = lst['name']
+
+        lst = data.get('listBefore')
+        if lst is not None:
+            r.list_before_id = lst['id']
+            r.list_before_name = lst['name']
+
+        lst = data.get('listAfter')
+        if lst is not None:
+            r.list_after_id = lst['id']
+            r.list_after_name = lst['name']
+
+        r.text = data.get('text')
+
+        member = d.get('member')
+        if member is not None:
+            r.member_id = member['id']
+            r.member_name = member.get('fullName')
+            if members_cache is not None:
+                _cache_member(members_cache, member)
+
+        creator = d.get('memberCreator')
+        if creator is not None:
+            r.member_creator_name = creator.get('fullName')
+            if members_cache is not None:
+                _cache_member(members_cache, creator)
+
+        return r
+
+    def to_json(self) -> str:
+        return json.dumps({name: getattr(self, name) for name in self.__slots__})
+
+    @classmethod
+    def from_json(cls, s: str):
+        """
+        Parses a record serialized by to_json. Fields missing from it,
+        like ones added since it was written, keep their defaults.
+        """
+        d = json.loads(s)
+        r = cls(d.get('id'), d.get('type'), d.get('changed_field'),
+                d.get('id_member_creator'), d.get('event', 0))
+        for name in cls.__slots__:
+            if name in d:
+                setattr(r, name, d[name])
+        return r
+
+    @property
+    def board(self):
+        return BoardRef(self.board_id, self.board_name, self.board_short_link)
+
+    @property
+    def board_url(self):
+        return BOARD_URL.format(self.board_short_link)
+
+    @property
+    def card_url(self):
+        return CARD_URL.format(self.card_short_link)
@@ -0,0 +1,146 @@
+from typing import *
+
+from bot import messages, subscriptions
+from bot.records import ActionRecord
+
+
+class UnsupportedActionError(RuntimeError):
+    pass
+
+
+class RendererRegistry:
+    """
+    Renderers of notification messages, dispatched on the action type and
+    the changed field of the action.
+    """
+
+    def __init__(self):
+        self._renderers = {} # (type, changed field) -> (renderer, event bit)
+
+    def register(self, type: str, changed_field: str=None, *, event: int):
+        def decorator(fn):
+            self._renderers[(type, changed_field)] = (fn, event)
+            return fn
+        return decorator
+
+    def _find(self, type, changed_field):
+        entry = self._renderers.get((type, changed_field))
+        if entry is None and changed_field is not None:
+            entry = self._renderers.get((type, None))
+        return entry
+
+    def supports(self, type: str, changed_field: str=None) -> bool:
+        return self._find(type, changed_field) is not None
+
+    def event_bit(self, type: str, changed_field: str=None) -> int:
+        """
+        Returns the subscription bit of the action kind, 0 if unsupported.
+        """
+        entry = self._find(type, changed_field)
+        return entry[1] if entry is not None else 0
+
+    def keys(self):
+        return self._renderers.keys()
+
+    def _render(self, action, session, member_names):
+        if action.message is not None:
+            return action.message
+
+        entry = self._find(action.type, action.changed_field)
+        if entry is None:
+            raise UnsupportedActionError(
+                "Messages for {} actions are not supported.".format(action.type))
+
+        user_name = action.member_creator_name
+        if user_name is None:
+            try:
+                user_name = member_names[action.id_member_creator]
+            except KeyError:
+                user_name = session.members.get(action.id_member_creator).fullname
+                member_names[action.id_member_creator] = user_name
+
+        fields = {
+            'user_name': user_name,
+            'card_text': action.card_name,
+            'card_url': action.card_url,
+            'board_name': action.board_name,
+            'board_url': action.board_url,
+        }
+        action.message = entry[0](action, fields)
+        return action.message
+
+    def render(self, action: ActionRecord, session=None) -> str:
+        """
+        Renders an action. The session is used to look up the member who
+        made the action, if the webhook payload did not include them.
+        """
+        return self._render(action, session, {})
+
+    def render_many(self, actions: List[ActionRecord], session=None) -> List[str]:
+        """
+        Renders a batch of actions, skipping unsupported ones.
+        Member names are resolved once per batch.
+        """
+        member_names = {}
+        msgs = []
+
+        for action in actions:
+            try:
+                msgs.append(self._render(action, session, member_names))
+            except UnsupportedActionError:
+                continue
+
+        return msgs
+
+
+registry = RendererRegistry()
+render = registry.render
+render_many = registry.render_many
+supports = registry.supports
+event_bit = registry.event_bit
+
+# Templates are looked up once, rather than on every rendering.
+_card_created = messages.HOOK_CARD_CREATED.format
+_card_moved = messages.HOOK_CARD_MOVED.format
+_card_archived = messages.HOOK_CARD_ARCHIVED.format
+_card_commented = messages.HOOK_CARD_COMMENTED.format
+_card_self_added = messages.HOOK_CARD_SELF_ADDED.format
+_card_member_added = messages.HOOK_CARD_MEMBER_ADDED.format
+_card_self_removed = messages.HOOK_CARD_SELF_REMOVED.format
+_card_member_removed = messages.HOOK_CARD_MEMBER_REMOVED.format
+
+
+@registry.register('createCard', event=subscriptions.CARD_CREATED)
+def render_card_created(action, fields):
+    return _card_created(list_name=action.list_name, **fields)
+
+
+@registry.register('updateCard', 'idList', event=subscriptions.CARD_MOVED)
+def render_card_moved(action, fields):
+    return _card_moved(old_list_name=action.list_before_name,
+                       new_list_name=action.list_after_name,
+                       **fields)
+
+
+@registry.register('updateCard', 'closed', event=subscriptions.CARD_ARCHIVED)
+def render_card_archived(action, fields):
+    return _card_archived(list_name=action.list_name, **fields)
+
+
+@registry.register('commentCard', event=subscriptions.CARD_COMMENTED)
+def render_card_commented(action, fields):
+    return _card_commented(text=action.text, **fields)
+
+
+@registry.register('addMemberToCard', event=subscriptions.CARD_MEMBERS)
+def render_card_member_added(action, fields):
+    if action.member_id == action.id_member_creator:
+        return _card_self_added(**fields)
+    return _card_member_added(other_user_name=action.member_name, **fields)
+
+
+@registry.register('removeMemberFromCard', event=subscriptions.CARD_MEMBERS)
+def render_card_member_removed(action, fields):
+    if action.member_id == action.id_member_creator:
+        return _card_self_removed(**fields)
+    return _card_member_removed(other_user_name=action.member_name, **fields)
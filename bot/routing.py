@@ -0,0 +1,128 @@
+import hashlib
+from collections import namedtuple
+from functools import lru_cache
+from threading import Lock
+
+from bot.models import BoardHook, Session
+from bot.subscriptions import ALL, Subscription
+
+Route = namedtuple('Route', ['hook_id', 'trello_token', 'subscription'])
+
+
+@lru_cache(maxsize=4096)
+def token_key(trello_token: str) -> str:
+    """
+    Identifies a token in webhook urls without disclosing it.
+    """
+    return hashlib.sha256(trello_token.encode('utf-8')).hexdigest()[:16]
+
+
+class RoutingTable:
+    """
+    In-memory copy of authorized chats and their board hooks, so that
+    webhook updates are routed without touching the database.
+    """
+
+    def __init__(self):
+        self._tokens = {} # chat id -> trello token
+        self._hooks = {} # (chat id, board id) -> (hook id, subscription)
+        self._boards = {} # board id -> set of chat ids
+        self._lock = Lock()
+
+    def load(self):
+        tokens = dict(
+            Session.select(Session.chat_id, Session.trello_token)
+                .where(Session.trello_token.is_null(False))
+                .tuples())
+
+        hooks = {}
+        boards = {}
+        query = BoardHook.select(BoardHook.id, BoardHook.session, BoardHook.board_id,
+                                 BoardHook.event_mask, BoardHook.list_ids,
+                                 BoardHook.member_ids)
+        for (hook_id, chat_id, board_id, *columns) in query.tuples():
+            hooks[(chat_id, board_id)] = (hook_id, Subscription.from_columns(*columns))
+            boards.setdefault(board_id, set()).add(chat_id)
+
+        with self._lock:
+            self._tokens = tokens
+            self._hooks = hooks
+            self._boards = boards
+
+    def has_chat(self, chat_id: int) -> bool:
+        return chat_id in self._tokens
+
+    def get(self, chat_id: int, board_id: str):
+        with self._lock:
+            try:
+                (hook_id, subscription) = self._hooks[(chat_id, board_id)]
+                return Route(hook_id, self._tokens[chat_id], subscription)
+            except KeyError:
+                return None
+
+    def board_routes(self, board_id: str, key: str):
+        """
+        Returns (chat id, route) pairs of the chats hooked to the board,
+        which are authorized with the token identified by `key`.
+        """
+        with self._lock:
+            routes = []
+            for chat_id in self._boards.get(board_id, ()):
+                try:
+                    (hook_id, subscription) = self._hooks[(chat_id, board_id)]
+                    trello_token = self._tokens[chat_id]
+                except KeyError:
+                    continue
+                if token_key(trello_token) == key:
+                    routes.append((chat_id, Route(hook_id, trello_token, subscription)))
+            return routes
+
+    def tokens(self):
+        with self._lock:
+            return set(self._tokens.values())
+
+    def token_boards(self, trello_token: str):
+        """
+        Returns ids of the boards hooked by chats authorized with the token.
+        """
+        with self._lock:
+            return {board_id for (chat_id, board_id) in self._hooks
+                    if self._tokens.get(chat_id) == trello_token}
+
+    def set_token(self, chat_id: int, trello_token: str):
+        with self._lock:
+            self._tokens[chat_id] = trello_token
+
+    def add_hook(self, chat_id: int, board_id: str, hook_id: int,
+                 subscription: Subscription=ALL):
+        with self._lock:
+            self._hooks[(chat_id, board_id)] = (hook_id, subscription)
+            self._boards.setdefault(board_id, set()).add(chat_id)
+
+    def set_subscription(self, chat_id: int, board_id: str, subscription: Subscription):
+        with self._lock:
+            key = (chat_id, board_id)
+            if key in self._hooks:
+                self._hooks[key] = (self._hooks[key][0], subscription)
+
+    def _remove_hook(self, chat_id, board_id):
+        self._hooks.pop((chat_id, board_id), None)
+
+        chats = self._boards.get(board_id)
+        if chats is not None:
+            chats.discard(chat_id)
+            if not chats:
+                del self._boards[board_id]
+
+    def remove_hook(self, chat_id: int, board_id: str):
+        with self._lock:
+            self._remove_hook(chat_id, board_id)
+
+    def remove_chat(self, chat_id: int):
+        with self._lock:
+            self._tokens.pop(chat_id, None)
+            for (_, board_id) in [k for k in self._hooks if k[0] == chat_id]:
+                self._remove_hook(chat_id, board_id)
+
+    def __len__(self):
+        return len(self._hooks)
@@ -0,0 +1,277 @@
+import logging
+import random
+import time
+from collections import OrderedDict, deque
+from threading import Condition, Lock, Thread
+
+from telegram.error import BadRequest, NetworkError
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self) -> float:
+        """
+        Returns the number of seconds until a token is available.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self._tokens >= 1:
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def consume(self) -> float:
+        """
+        Takes a token if one is available and returns 0,
+        otherwise returns the number of seconds to wait for it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def is_idle(self, now: float) -> bool:
+        """
+        Returns True, if the bucket has been full for longer than it takes
+        to refill it, so a new bucket would behave the same.
+        """
+        with self._lock:
+            self._refill(now)
+            return (self._tokens >= self.capacity and
+                    now >= self._paused_until + self.capacity / self.rate)
+
+
+class _Shard:
+
+    def __init__(self):
+        self.cond = Condition()
+        self.pending = OrderedDict() # chat id -> deque of [kwargs, attempts, on_done]
+
+
+# Seconds between sweeps of idle per chat buckets
+BUCKET_SWEEP_INTERVAL = 60
+
+
+class OutboundSender:
+    """
+    Sends Telegram messages from a small pool of workers, keeping within
+    the global and per-chat rate limits of the Bot API.
+
+    Chats are sharded between workers, so messages to a chat are sent in
+    the order they were submitted.
+    """
+
+    def __init__(self, send_func, *, workers=4,
+                 global_rate=30, chat_rate=1, group_rate=20/60,
+                 max_attempts=5, on_failure=None):
+        self.send_func = send_func
+        self.on_failure = on_failure
+        self.max_attempts = max_attempts
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._chat_buckets_lock = Lock()
+        self._swept = time.monotonic()
+
+        self._shards = [_Shard() for _ in range(workers)]
+        self._threads = []
+        self._running = False
+
+        self._stats_lock = Lock()
+        self._sent = 0
+        self._retried = 0
+        self._failed = 0
+
+    def _chat_bucket(self, chat_id):
+        with self._chat_buckets_lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                # Group chats have negative ids.
+                rate = self.group_rate if chat_id < 0 else self.chat_rate
+                bucket = self._chat_buckets[chat_id] = TokenBucket(rate, 1)
+            return bucket
+
+    def _sweep_buckets(self):
+        now = time.monotonic()
+        with self._chat_buckets_lock:
+            if now - self._swept < BUCKET_SWEEP_INTERVAL:
+                return
+            self._swept = now
+            idle = [c for (c, b) in self._chat_buckets.items() if b.is_idle(now)]
+
+        # Buckets of chats with pending messages may be in use by a worker.
+        # Shard locks are not taken under the buckets lock, as workers
+        # take them in the opposite order.
+        busy = set()
+        for chat_id in idle:
+            shard = self._shard(chat_id)
+            with shard.cond:
+                if chat_id in shard.pending:
+                    busy.add(chat_id)
+
+        with self._chat_buckets_lock:
+            for chat_id in idle:
+                bucket = self._chat_buckets.get(chat_id)
+                if chat_id not in busy and bucket is not None and bucket.is_idle(now):
+                    del self._chat_buckets[chat_id]
+
+    def _shard(self, chat_id):
+        return self._shards[hash(chat_id) % len(self._shards)]
+
+    def submit(self, chat_id: int, on_done=None, **kwargs):
+        """
+        Queues a message. `on_done` is called once the message is sent,
+        or dropped after its last attempt.
+        """
+        self._sweep_buckets()
+
+        shard = self._shard(chat_id)
+        with shard.cond:
+            shard.pending.setdefault(chat_id, deque()).append([kwargs, 0, on_done])
+            shard.cond.notify()
+
+    def _next_chat(self, shard):
+        with shard.cond:
+            while self._running:
+                timeout = None
+                for chat_id in shard.pending:
+                    delay = self._chat_bucket(chat_id).delay()
+                    if delay <= 0:
+                        return chat_id
+                    if timeout is None or delay < timeout:
+                        timeout = delay
+
+                shard.cond.wait(timeout)
+
+        return None
+
+    def _retry_delay(self, error, attempts):
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            return float(retry_after)
+
+        if isinstance(error, NetworkError) and not isinstance(error, BadRequest):
+            return min(2 ** attempts, 60) * random.uniform(0.5, 1.5)
+
+        return None
+
+    def _work(self, shard):
+        while True:
+            chat_id = self._next_chat(shard)
+            if chat_id is None:
+                return
+
+            with shard.cond:
+                item = shard.pending[chat_id][0]
+            (kwargs, attempts, on_done) = item
+
+            delay = self.global_bucket.consume()
+            while delay > 0:
+                time.sleep(delay)
+                delay = self.global_bucket.consume()
+            self._chat_bucket(chat_id).consume()
+
+            try:
+                self.send_func(chat_id, **kwargs)
+                done = True
+                with self._stats_lock:
+                    self._sent += 1
+            except Exception as e:
+                item[1] = attempts = attempts + 1
+                retry_delay = self._retry_delay(e, attempts)
+
+                if retry_delay is not None and attempts < self.max_attempts:
+                    logger.warning("Sending to chat id {} failed: {}, retry in {:.1f}s.".format(
+                        chat_id, repr(e), retry_delay))
+                    self._chat_bucket(chat_id).pause(retry_delay)
+                    done = False
+                    with self._stats_lock:
+                        self._retried += 1
+                else:
+                    done = True
+                    with self._stats_lock:
+                        self._failed += 1
+                    if self.on_failure:
+                        self.on_failure(chat_id, kwargs, e)
+
+            if done:
+                with shard.cond:
+                    chat_queue = shard.pending[chat_id]
+                    chat_queue.popleft()
+                    if not chat_queue:
+                        del shard.pending[chat_id]
+                    else:
+                        # Let other chats of the shard go first.
+                        shard.pending.move_to_end(chat_id)
+
+                if on_done:
+                    try:
+                        on_done()
+                    except Exception as e:
+                        logger.error("Delivery callback for chat id {} failed: {}.".format(
+                            chat_id, repr(e)))
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+
+        for shard in self._shards:
+            t = Thread(target=self._work, args=(shard,), daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        self._running = False
+        for shard in self._shards:
+            with shard.cond:
+                shard.cond.notify()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def stats(self):
+        depth = 0
+        for shard in self._shards:
+            with shard.cond:
+                depth += sum(len(q) for q in shard.pending.values())
+
+        with self._stats_lock:
+            return {
+                'depth': depth,
+                'chat_buckets': len(self._chat_buckets),
+                'sent': self._sent,
+                'retried': self._retried,
+                'failed': self._failed,
+            }
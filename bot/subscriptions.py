@@ -0,0 +1,77 @@
+from typing import *
+
+from bot import messages
+
+CARD_CREATED = 1 << 0
+CARD_MOVED = 1 << 1
+CARD_ARCHIVED = 1 << 2
+CARD_COMMENTED = 1 << 3
+CARD_MEMBERS = 1 << 4
+
+# Every bit set, including the ones of event types added later.
+ALL_EVENTS = -1
+
+EVENT_NAMES = [
+    (CARD_CREATED, messages.FILTER_EVENT_CREATED),
+    (CARD_MOVED, messages.FILTER_EVENT_MOVED),
+    (CARD_ARCHIVED, messages.FILTER_EVENT_ARCHIVED),
+    (CARD_COMMENTED, messages.FILTER_EVENT_COMMENTED),
+    (CARD_MEMBERS, messages.FILTER_EVENT_MEMBERS),
+]
+
+
+def _split_ids(ids: str) -> FrozenSet[str]:
+    return frozenset(i for i in ids.split(',') if i) if ids else frozenset()
+
+
+class Subscription:
+    """
+    Events a chat is notified about for a board: a bitmask of event types,
+    and optionally the lists and the members the events must concern.
+    Empty sets of lists or members match any.
+    """
+
+    __slots__ = ('mask', 'list_ids', 'member_ids')
+
+    def __init__(self, mask: int=ALL_EVENTS,
+                 list_ids: Iterable[str]=(), member_ids: Iterable[str]=()):
+        self.mask = mask
+        self.list_ids = frozenset(list_ids)
+        self.member_ids = frozenset(member_ids)
+
+    @classmethod
+    def from_columns(cls, event_mask: int, list_ids: str, member_ids: str):
+        return cls(event_mask, _split_ids(list_ids), _split_ids(member_ids))
+
+    @classmethod
+    def of_hook(cls, hook):
+        return cls.from_columns(hook.event_mask, hook.list_ids, hook.member_ids)
+
+    def to_columns(self) -> Dict[str, Any]:
+        return {
+            'event_mask': self.mask,
+            'list_ids': ','.join(sorted(self.list_ids)),
+            'member_ids': ','.join(sorted(self.member_ids)),
+        }
+
+    def wants(self, event: int) -> bool:
+        return bool(self.mask & event)
+
+    def matches(self, action) -> bool:
+        if not self.mask & action.event:
+            return False
+
+        # Actions without list data, like card member changes, pass the
+        # list filter: which list they concern is not known.
+        action_lists = {action.list_id, action.list_before_id, action.list_after_id}
+        action_lists.discard(None)
+        if self.list_ids and action_lists and not (action_lists & self.list_ids):
+            return False
+
+        if self.member_ids and action.id_member_creator not in self.member_ids:
+            return False
+
+        return True
+
+
+ALL = Subscription()
@@ -1,9 +1,20 @@
+import bisect
+import random
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from bot.cache import TaggedCache, TTLCache
 
 TRELLO_API_URL = 'https://trello.com/1'
 
+# Maximum number of urls in a single /batch request
+BATCH_LIMIT = 10
+
 
 class TrelloError(Exception):
     def __init__(self, session, status_code, url, text, desc="API call error"):
@@ -42,10 +53,195 @@ class RequestError(CustomTrelloError):
     status_code = 400
     desc = "Invalid data"
 
+class RateLimitError(CustomTrelloError):
+    status_code = 429
+    desc = "Rate limit exceeded"
+
+
+class RateGovernor:
+    """
+    Keeps requests within Trello rate limits: `key_limit` requests per
+    `window` seconds for the API key and `token_limit` for every token.
+
+    Requests reserve a slot in the sliding windows of both limits and wait
+    until it comes. Rate limit headers of responses and 429 responses,
+    which account for requests made by other processes with the same key,
+    hold off further requests until the window passes.
+    """
+
+    def __init__(self, key_limit=300, token_limit=100, window=10):
+        self.key_limit = key_limit
+        self.token_limit = token_limit
+        self.window = window
+
+        self._key_slots = [] # Sorted request times
+        self._token_slots = {} # token -> sorted request times
+        self._key_blocked_until = 0
+        self._token_blocked_until = {}
+        self._swept = time.monotonic()
+        self._lock = Lock()
+
+        self.throttled = 0
+        self.limited = 0
+
+    def _prune(self, slots, now):
+        del slots[:bisect.bisect_left(slots, now - self.window)]
+
+    def _sweep(self, now):
+        """
+        Forgets tokens without requests in the window, which are not held off.
+        """
+        self._swept = now
+        for token in set(self._token_slots) | set(self._token_blocked_until):
+            slots = self._token_slots.get(token)
+            if slots:
+                self._prune(slots, now)
+            if not slots and self._token_blocked_until.get(token, 0) <= now:
+                self._token_slots.pop(token, None)
+                self._token_blocked_until.pop(token, None)
+
+    def reserve(self, token):
+        """
+        Reserves a request slot for the token.
+        Returns the number of seconds to wait before making the request.
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            self._prune(self._key_slots, now)
+            token_slots = self._token_slots.setdefault(token, [])
+            self._prune(token_slots, now)
+
+            at = max(now, self._key_blocked_until,
+                     self._token_blocked_until.get(token, 0))
+            if len(self._key_slots) >= self.key_limit:
+                at = max(at, self._key_slots[-self.key_limit] + self.window)
+            if len(token_slots) >= self.token_limit:
+                at = max(at, token_slots[-self.token_limit] + self.window)
+
+            bisect.insort(self._key_slots, at)
+            bisect.insort(token_slots, at)
+
+            if now - self._swept >= self.window:
+                self._sweep(now)
+
+            if at > now:
+                self.throttled += 1
+            return at - now
+
+    def observe(self, token, headers):
+        """
+        Holds off requests when the rate limit headers of a response
+        report no requests left.
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            if headers.get('x-rate-limit-api-key-remaining') == '0':
+                interval = int(headers.get('x-rate-limit-api-key-interval-ms',
+                                           self.window * 1000)) / 1000
+                self._key_blocked_until = max(self._key_blocked_until, now + interval)
+
+            if headers.get('x-rate-limit-api-token-remaining') == '0':
+                interval = int(headers.get('x-rate-limit-api-token-interval-ms',
+                                           self.window * 1000)) / 1000
+                self._token_blocked_until[token] = max(
+                    self._token_blocked_until.get(token, 0), now + interval)
+
+    def backoff(self, token, attempt):
+        """
+        Holds off requests of the token after a 429 response.
+        Returns the number of seconds to wait before retrying.
+        """
+        delay = min(self.window, 2 ** attempt) * random.uniform(0.5, 1.5)
+
+        with self._lock:
+            self.limited += 1
+            self._token_blocked_until[token] = max(
+                self._token_blocked_until.get(token, 0), time.monotonic() + delay)
+
+        return delay
+
+    def stats(self):
+        with self._lock:
+            return {
+                'tokens': len(self._token_slots),
+                'throttled': self.throttled,
+                'limited': self.limited,
+            }
+
+
+class Transport:
+    """
+    Keep-alive HTTP connection pool shared by every session of an app.
+    """
+
+    def __init__(self, pool_size=10, timeout=(5, 30)):
+        self.timeout = timeout
+
+        self._http = requests.Session()
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._http.mount('https://', self._adapter)
+        self._http.mount('http://', self._adapter)
+
+        self._requests_count = 0
+        self._stats_lock = Lock()
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+
+        with self._stats_lock:
+            self._requests_count += 1
+
+        return self._http.request(method, url, **kwargs)
+
+    def stats(self):
+        connections = 0
+        open_connections = 0
+        for pool in self._adapter.poolmanager.pools.values():
+            connections += pool.num_connections
+            open_connections += sum(1 for conn in list(pool.pool.queue)
+                                    if conn is not None and conn.sock is not None)
+
+        with self._stats_lock:
+            requests_count = self._requests_count
+
+        if requests_count:
+            reuse_ratio = 1 - connections / requests_count
+        else:
+            reuse_ratio = 0.0
+
+        return {
+            'requests': requests_count,
+            'connections': connections,
+            'open_connections': open_connections,
+            'reuse_ratio': max(reuse_ratio, 0.0),
+        }
+
+    def close(self):
+        self._http.close()
+
 
 class App:
-    def __init__(self, key):
+    def __init__(self, key, *, pool_size=10, timeout=(5, 30),
+                 member_cache_size=4096, member_cache_ttl=3600,
+                 metadata_cache_size=4096, metadata_cache_ttl=600,
+                 key_rate_limit=300, token_rate_limit=100, rate_limit_retries=3):
         self.key = key
+        self.transport = Transport(pool_size=pool_size, timeout=timeout)
+
+        # Rate limits are per key and per token, so the governor is shared
+        # by all sessions, synchronous and async.
+        self.governor = RateGovernor(key_rate_limit, token_rate_limit)
+        self.rate_limit_retries = rate_limit_retries
+
+        # Member fields by member id. Members are the same for every token,
+        # so the cache is shared by all sessions.
+        self.members_cache = TTLCache(member_cache_size, member_cache_ttl)
+
+        # Boards, their lists and members as seen by a token. Entries are
+        # tagged with the board id, to be invalidated by webhook actions.
+        self.metadata_cache = TaggedCache(metadata_cache_size, metadata_cache_ttl)
 
     def auth_url(self):
         params = {
@@ -81,19 +277,35 @@ class Session:
         params['key'] = self.app.key
         params['token'] = self.token
 
-        r = requests.request(method, TRELLO_API_URL + url, params=params, data=data)
+        governor = self.app.governor
+        attempt = 0
+        while True:
+            time.sleep(governor.reserve(self.token))
+            r = self.app.transport.request(method, TRELLO_API_URL + url,
+                                           params=params, data=data)
+            governor.observe(self.token, r.headers)
+
+            if r.status_code != 429 or attempt >= self.app.rate_limit_retries:
+                break
+            time.sleep(governor.backoff(self.token, attempt))
+            attempt += 1
 
-        if r.status_code == 400:
-            raise RequestError(self, url, r.text)
-        if r.status_code == 401:
-            raise AuthError(self, url, r.text)
-        if r.status_code == 404:
-            raise NotFoundError(self, url, r.text)
-        elif r.status_code != 200:
-            raise TrelloError(self, r.status_code, url, r.text)
+        self._raise_for_status(r.status_code, url, r.text)
 
         return r.json()
 
+    def _raise_for_status(self, status_code, url, text):
+        if status_code == 400:
+            raise RequestError(self, url, text)
+        if status_code == 401:
+            raise AuthError(self, url, text)
+        if status_code == 404:
+            raise NotFoundError(self, url, text)
+        if status_code == 429:
+            raise RateLimitError(self, url, text)
+        elif status_code != 200:
+            raise TrelloError(self, status_code, url, text)
+
     def _api_get(self, url, *, params=None):
         return self._api_request('get', url, params)
 
@@ -107,6 +319,18 @@ class Session:
         return self._api_request('delete', url, params)
 
 
+def _fields_params(fields, prefix=''):
+    """
+    Returns request params selecting only `fields` of a resource, or of
+    its nested resource `prefix`.
+    """
+    if not fields:
+        return {}
+    if not isinstance(fields, str):
+        fields = ','.join(fields)
+    return {prefix + 'fields': fields}
+
+
 class API:
     def __init__(self, session, model_class):
         self.session = session
@@ -116,14 +340,85 @@ class API:
     def url_base(self):
         return self.model_class.url_base
 
-    def all(self):
-        json = self.session._api_get(self.url_base)
+    def _fields_params(self, fields):
+        return _fields_params(fields or self.model_class.fields)
+
+    def all(self, *, fields=None):
+        json = self.session._api_get(self.url_base, params=self._fields_params(fields))
         return [self.model_class.from_dict(self.session, m) for m in json]
 
-    def get(self, id):
-        json = self.session._api_get(self.url_base + '/' + id)
+    def get(self, id, *, fields=None):
+        json = self.session._api_get(self.url_base + '/' + id,
+                                     params=self._fields_params(fields))
         return self.model_class.from_dict(self.session, json)
 
+    def get_many(self, ids):
+        """
+        Retrieves models by their ids in as few requests as possible.
+        Returns a dict of models by id; ids that were not found are left out.
+        """
+        ids = list(ids)
+        if not ids:
+            return {}
+
+        try:
+            return self._get_many_batched(ids)
+        except (AuthError, RateLimitError):
+            raise
+        except TrelloError:
+            return self._get_many_concurrent(ids)
+
+    def _get_many_batched(self, ids):
+        models = {}
+
+        for i in range(0, len(ids), BATCH_LIMIT):
+            chunk = ids[i:i + BATCH_LIMIT]
+            urls = self._batch_urls(chunk)
+            json = self.session._api_get('/batch', params={'urls': ','.join(urls)})
+            models.update(self._batch_models(chunk, urls, json))
+
+        return models
+
+    def _batch_urls(self, ids):
+        # Commas separate the urls, so the ones of fields are escaped.
+        query = urllib.parse.urlencode(self._fields_params(None))
+        return [self.url_base + '/' + id + ('?' + query if query else '')
+                for id in ids]
+
+    def _batch_models(self, ids, urls, json):
+        models = {}
+
+        for (id, url, item) in zip(ids, urls, json):
+            if '200' in item:
+                models[id] = self.model_class.from_dict(self.session, item['200'])
+                continue
+
+            status_code = item.get('statusCode')
+            if status_code is None:
+                try:
+                    status_code = int(next(iter(item)))
+                except (StopIteration, ValueError):
+                    raise TrelloError(self.session, 0, url, str(item),
+                                      "Malformed batch response")
+
+            try:
+                self.session._raise_for_status(status_code, url, str(item))
+            except NotFoundError:
+                continue
+
+        return models
+
+    def _get_many_concurrent(self, ids):
+        def get_or_none(id):
+            try:
+                return self.get(id)
+            except NotFoundError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=min(len(ids), BATCH_LIMIT)) as executor:
+            found = executor.map(get_or_none, ids)
+            return {id: m for (id, m) in zip(ids, found) if m is not None}
+
     def add(self, **kwargs):
         json = self.session._api_post(self.url_base, data=kwargs)
         return self.model_class.from_dict(self.session, json)
@@ -132,8 +427,22 @@ class MembersAPI(API):
     def __init__(self, session):
         super().__init__(session, Member)
 
-    def me(self):
-        json = self.session._api_get(self.url_base + '/me')
+    def get(self, id, *, fields=None):
+        if fields is not None:
+            return super().get(id, fields=fields)
+
+        cached = self.session.app.members_cache.get(id)
+        if cached is not None:
+            return Member(self.session, id, *cached)
+
+        member = super().get(id)
+        member.cache()
+        return member
+
+    def me(self, *, fields=None):
+        # Never cached: commands call it to check that the token is valid.
+        json = self.session._api_get(self.url_base + '/me',
+                                     params=self._fields_params(fields))
         return Member.from_dict(self.session, json)
 
 class ActionsAPI(API):
@@ -144,10 +453,49 @@ class WebhooksAPI(API):
     def __init__(self, session):
         super().__init__(session, Webhook)
 
+    def all(self, *, fields=None):
+        # Webhooks can only be listed per token.
+        json = self.session._api_get('/tokens/{}/webhooks'.format(self.session.token),
+                                     params=self._fields_params(fields))
+        return [Webhook.from_dict(self.session, d) for d in json]
+
 class BoardsAPI(API):
     def __init__(self, session):
         super().__init__(session, Board)
 
+    def _cached(self, id):
+        fields = self.session.app.metadata_cache.get(Board.cache_key(self.session, id))
+        if fields is None:
+            return None
+        return Board(self.session, id, *fields)
+
+    def get(self, id, *, fields=None):
+        if fields is not None:
+            return super().get(id, fields=fields)
+
+        board = self._cached(id)
+        if board is None:
+            board = super().get(id)
+            board.cache()
+        return board
+
+    def get_many(self, ids):
+        boards = {}
+        missing = []
+        for id in ids:
+            board = self._cached(id)
+            if board is None:
+                missing.append(id)
+            else:
+                boards[id] = board
+
+        fetched = super().get_many(missing)
+        for board in fetched.values():
+            board.cache()
+        boards.update(fetched)
+
+        return boards
+
 class ListsAPI(API):
     def __init__(self, session):
         super().__init__(session, List)
@@ -158,6 +506,8 @@ class CardsAPI(API):
 
 class Model:
     url_base = ''
+    # Fields of the resource read by from_dict, requested by default
+    fields = None
 
     def __init__(self, session, id):
         self.session = session
@@ -171,10 +521,11 @@ class Model:
         return "{base}/{id}{url}".format(base=self.url_base, id=self.id, url=url)
 
     def delete(self):
-        self._api_delete(self.url_base + '/' + self.id)
+        self.session._api_delete(self.url_base + '/' + self.id)
 
 class Member(Model):
     url_base = '/members'
+    fields = 'username,fullName,url'
 
     def __init__(self, session, id, username, fullname, url):
         self.session = session
@@ -191,19 +542,31 @@ class Member(Model):
                       d.get('fullName'),
                       d.get('url'))
 
-    def boards(self, *, filter=None):
-        params = {}
+    def cache(self):
+        self.session.app.members_cache.put(
+            self.id, (self.username, self.fullname, self.url))
+
+    def boards(self, *, filter=None, fields=None):
+        params = _fields_params(fields or Board.fields)
 
         if filter:
             if isinstance(filter, list):
                 filter = ','.join(filter)
             params['filter'] = filter
 
+        # The list itself is not cached: no webhook reports boards being
+        # created or the member being added to one. The boards warm the cache.
         json = self.session._api_get(self._sub_url('/boards'), params=params)
-        return [Board.from_dict(self.session, d) for d in json]
+        boards = [Board.from_dict(self.session, d) for d in json]
+        if fields is None:
+            for b in boards:
+                b.cache()
+
+        return boards
 
 class Action(Model):
     url_base = '/actions'
+    fields = 'idMemberCreator,type,data'
 
     def __init__(self, session, id, id_member_creator, type,
                  changed_field=None, old_value=None):
@@ -238,9 +601,11 @@ class Action(Model):
 
         if 'member' in d:
             action.member = Member.from_dict(session, d['member'])
+            action.member.cache()
 
         if 'memberCreator' in d:
             action._member_creator = Member.from_dict(session, d['memberCreator'])
+            action._member_creator.cache()
 
         if 'old' in data:
             action.changed_field = list(data['old'].keys())[0]
@@ -252,10 +617,12 @@ class Action(Model):
         if hasattr(self, '_member_creator'):
             return self._member_creator
 
-        return self.session.members.get(self.id_member_creator)
+        self._member_creator = self.session.members.get(self.id_member_creator)
+        return self._member_creator
 
 class Webhook(Model):
     url_base = '/webhooks'
+    fields = 'callbackURL,idModel,description'
 
     def __init__(self, session, id, callback_url, id_model, description=""):
         super().__init__(session, id)
@@ -274,6 +641,7 @@ class Webhook(Model):
 
 class Card(Model):
     url_base = '/cards'
+    fields = 'name,idList,shortLink'
 
     def __init__(self, session, id, name, id_list, short_link=None):
         self.session = session
@@ -287,7 +655,7 @@ class Card(Model):
         return Card(session,
                     d['id'],
                     d['name'],
-                    d.get('id_list'),
+                    d.get('idList'),
                     d.get('shortLink'))
 
     @property
@@ -299,6 +667,8 @@ class Card(Model):
 
 class Board(Model):
     url_base = '/boards'
+    # The description is left out: nothing shows it and it can be long.
+    fields = 'name,shortLink'
 
     def __init__(self, session, id, name, desc, short_link=None):
         self.session = session
@@ -319,17 +689,64 @@ class Board(Model):
     def url(self):
         return "https://trello.com/b/{}/".format(self.short_link)
 
-    def actions(self):
-        json = self.session._api_get(self._sub_url('/actions'))
+    @staticmethod
+    def cache_key(session, id):
+        return ('board', session.token, id)
+
+    def cache(self):
+        self.session.app.metadata_cache.put(
+            Board.cache_key(self.session, self.id),
+            (self.name, self.desc, self.short_link), tags=(self.id,))
+
+    def actions(self, *, fields=None):
+        params = _fields_params(fields or Action.fields)
+        params.update(_fields_params(Member.fields, 'member_'))
+        params.update(_fields_params(Member.fields, 'memberCreator_'))
+
+        json = self.session._api_get(self._sub_url('/actions'), params=params)
         return [Action.from_dict(self.session, d) for d in json]
 
-    def lists(self):
-        json = self.session._api_get(self._sub_url('/lists'))
-        return [List.from_dict(self.session, d) for d in json]
+    def lists(self, *, fields=None):
+        if fields is not None:
+            json = self.session._api_get(self._sub_url('/lists'),
+                                         params=_fields_params(fields))
+            return [List.from_dict(self.session, d) for d in json]
+
+        cache = self.session.app.metadata_cache
+        key = ('board_lists', self.session.token, self.id)
+
+        fields = cache.get(key)
+        if fields is None:
+            json = self.session._api_get(self._sub_url('/lists'),
+                                         params=_fields_params(List.fields))
+            fields = [(d['id'], d['name']) for d in json]
+            cache.put(key, fields, tags=(self.id,))
+
+        return [List(self.session, *f) for f in fields]
+
+    def members(self, *, fields=None):
+        if fields is not None:
+            json = self.session._api_get(self._sub_url('/members'),
+                                         params=_fields_params(fields))
+            return [Member.from_dict(self.session, d) for d in json]
+
+        cache = self.session.app.metadata_cache
+        key = ('board_members', self.session.token, self.id)
+
+        fields = cache.get(key)
+        if fields is None:
+            json = self.session._api_get(self._sub_url('/members'),
+                                         params=_fields_params(Member.fields))
+            fields = [(d['id'], d.get('username'), d.get('fullName'), d.get('url'))
+                      for d in json]
+            cache.put(key, fields, tags=(self.id,))
+
+        return [Member(self.session, *f) for f in fields]
 
 
 class List(Model):
     url_base = '/lists'
+    fields = 'name'
 
     def __init__(self, session, id, name):
         self.session = session
@@ -342,12 +759,14 @@ class List(Model):
                      d['id'],
                      d['name'])
 
-    def board(self):
-        json = self.session._api_get(self._sub_url('/board'))
+    def board(self, *, fields=None):
+        json = self.session._api_get(self._sub_url('/board'),
+                                     params=_fields_params(fields or Board.fields))
         return Board.from_dict(self.session, json)
 
-    def cards(self):
-        json = self.session._api_get(self._sub_url('/cards'))
+    def cards(self, *, fields=None):
+        json = self.session._api_get(self._sub_url('/cards'),
+                                     params=_fields_params(fields or Card.fields))
 
         cs = [Card.from_dict(self.session, d) for d in json]
         for c in cs:
@@ -0,0 +1,334 @@
+"""
+Asyncio counterpart of trello.Session, for gathering many API calls at once.
+Requires the optional aiohttp package.
+"""
+import asyncio
+import json
+from threading import Lock, Thread
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from bot import trello
+
+
+class AsyncClient:
+    """
+    HTTP client shared by every async session of an app. At most `limit`
+    requests are in flight at a time; others wait for a free slot.
+
+    `timeout` is either the total number of seconds of a request, or
+    a (connect, read) tuple like the one of trello.Transport.
+    """
+
+    def __init__(self, app, *, limit=10, timeout=(5, 30)):
+        if aiohttp is None:
+            raise RuntimeError("aiohttp is required for the async Trello client")
+
+        self.app = app
+        self.limit = limit
+        if isinstance(timeout, tuple):
+            (connect, read) = timeout
+            self.timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        else:
+            self.timeout = aiohttp.ClientTimeout(total=timeout)
+
+        self._http = None
+        self._semaphore = None
+
+        self._loop = None
+        self._loop_lock = Lock()
+
+    def session(self, token):
+        return AsyncSession(self, token)
+
+    def _ensure_http(self):
+        # Created lazily, so the client is bound to the running event loop.
+        if self._http is None:
+            connector = aiohttp.TCPConnector(limit=self.limit)
+            self._http = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._semaphore = asyncio.Semaphore(self.limit)
+
+    def run(self, coro):
+        """
+        Runs a coroutine on the event loop of the client and returns its
+        result. Lets threads without an event loop, like command handlers,
+        gather requests.
+        """
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                Thread(target=self._loop.run_forever, daemon=True).start()
+
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def request(self, method, url, params=None, data=None):
+        self._ensure_http()
+
+        async with self._semaphore:
+            async with self._http.request(method, url, params=params, data=data) as r:
+                return (r.status, r.headers, await r.text())
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+
+class AsyncSession:
+    """
+    Mirrors the APIs of trello.Session with coroutines. Models are bound to
+    the synchronous session of the same token, so their helper methods stay
+    usable outside of the event loop.
+    """
+
+    def __init__(self, client, token):
+        self.client = client
+        self.app = client.app
+        self.token = token
+        self.sync = self.app.session(token)
+
+        self.members = AsyncMembersAPI(self)
+        self.actions = AsyncActionsAPI(self)
+        self.webhooks = AsyncWebhooksAPI(self)
+
+        self.boards = AsyncBoardsAPI(self)
+        self.lists = AsyncListsAPI(self)
+        self.cards = AsyncCardsAPI(self)
+
+    async def _api_request(self, method, url, params=None, data=None):
+        if params is None: params = {}
+
+        params['key'] = self.app.key
+        params['token'] = self.token
+
+        governor = self.app.governor
+        attempt = 0
+        while True:
+            await asyncio.sleep(governor.reserve(self.token))
+            (status_code, headers, text) = await self.client.request(
+                method, trello.TRELLO_API_URL + url, params=params, data=data)
+            governor.observe(self.token, headers)
+
+            if status_code != 429 or attempt >= self.app.rate_limit_retries:
+                break
+            await asyncio.sleep(governor.backoff(self.token, attempt))
+            attempt += 1
+
+        self.sync._raise_for_status(status_code, url, text)
+
+        return json.loads(text)
+
+    async def _api_get(self, url, *, params=None):
+        return await self._api_request('get', url, params)
+
+    async def _api_post(self, url, *, params=None, data=None):
+        return await self._api_request('post', url, params, data)
+
+    async def _api_put(self, url, *, params=None, data=None):
+        return await self._api_request('put', url, params, data)
+
+    async def _api_delete(self, url, *, params=None):
+        return await self._api_request('delete', url, params)
+
+
+class AsyncAPI:
+    def __init__(self, session, model_class):
+        self.session = session
+        self.model_class = model_class
+        # Builds and reads /batch requests, which do not depend on the loop.
+        self._batch = trello.API(session.sync, model_class)
+
+    @property
+    def url_base(self):
+        return self.model_class.url_base
+
+    def _model(self, d):
+        return self.model_class.from_dict(self.session.sync, d)
+
+    def _models(self, json):
+        return [self._model(d) for d in json]
+
+    def _sub_url(self, id, url):
+        return "{base}/{id}{url}".format(base=self.url_base, id=id, url=url)
+
+    def _fields_params(self, fields):
+        return trello._fields_params(fields or self.model_class.fields)
+
+    async def all(self, *, fields=None):
+        return self._models(await self.session._api_get(
+            self.url_base, params=self._fields_params(fields)))
+
+    async def get(self, id, *, fields=None):
+        return self._model(await self.session._api_get(
+            self.url_base + '/' + id, params=self._fields_params(fields)))
+
+    async def get_many(self, ids):
+        """
+        Retrieves models by their ids in as few requests as possible, like
+        trello.API.get_many, with the /batch requests sent concurrently.
+        Returns a dict of models by id; ids that were not found are left out.
+        """
+        ids = list(ids)
+        if not ids:
+            return {}
+
+        try:
+            return await self._get_many_batched(ids)
+        except (trello.AuthError, trello.RateLimitError):
+            raise
+        except trello.TrelloError:
+            return await self._get_many_concurrent(ids)
+
+    async def _get_many_batched(self, ids):
+        async def get_chunk(chunk):
+            urls = self._batch._batch_urls(chunk)
+            json = await self.session._api_get('/batch', params={'urls': ','.join(urls)})
+            return self._batch._batch_models(chunk, urls, json)
+
+        chunks = [ids[i:i + trello.BATCH_LIMIT]
+                  for i in range(0, len(ids), trello.BATCH_LIMIT)]
+        models = {}
+        for found in await asyncio.gather(*[get_chunk(c) for c in chunks]):
+            models.update(found)
+        return models
+
+    async def _get_many_concurrent(self, ids):
+        async def get_or_none(id):
+            try:
+                return await self.get(id)
+            except trello.NotFoundError:
+                return None
+
+        found = await asyncio.gather(*[get_or_none(id) for id in ids])
+        return {id: m for (id, m) in zip(ids, found) if m is not None}
+
+    async def add(self, **kwargs):
+        return self._model(await self.session._api_post(self.url_base, data=kwargs))
+
+    async def delete(self, id):
+        await self.session._api_delete(self.url_base + '/' + id)
+
+class AsyncMembersAPI(AsyncAPI):
+    def __init__(self, session):
+        super().__init__(session, trello.Member)
+
+    async def get(self, id, *, fields=None):
+        if fields is not None:
+            return await super().get(id, fields=fields)
+
+        cached = self.session.app.members_cache.get(id)
+        if cached is not None:
+            return trello.Member(self.session.sync, id, *cached)
+
+        member = await super().get(id)
+        member.cache()
+        return member
+
+    async def me(self, *, fields=None):
+        return self._model(await self.session._api_get(
+            self.url_base + '/me', params=self._fields_params(fields)))
+
+    async def boards(self, id, *, filter=None, fields=None):
+        params = trello._fields_params(fields or trello.Board.fields)
+
+        if filter:
+            if isinstance(filter, list):
+                filter = ','.join(filter)
+            params['filter'] = filter
+
+        json = await self.session._api_get(self._sub_url(id, '/boards'), params=params)
+        return [trello.Board.from_dict(self.session.sync, d) for d in json]
+
+class AsyncActionsAPI(AsyncAPI):
+    def __init__(self, session):
+        super().__init__(session, trello.Action)
+
+class AsyncWebhooksAPI(AsyncAPI):
+    def __init__(self, session):
+        super().__init__(session, trello.Webhook)
+
+    async def all(self, *, fields=None):
+        # Webhooks can only be listed per token.
+        return self._models(await self.session._api_get(
+            '/tokens/{}/webhooks'.format(self.session.token),
+            params=self._fields_params(fields)))
+
+class AsyncBoardsAPI(AsyncAPI):
+    def __init__(self, session):
+        super().__init__(session, trello.Board)
+
+    async def get(self, id, *, fields=None):
+        # Boards share the metadata cache of the synchronous API.
+        if fields is not None:
+            return await super().get(id, fields=fields)
+
+        board = self.session.sync.boards._cached(id)
+        if board is None:
+            board = await super().get(id)
+            board.cache()
+        return board
+
+    async def get_many(self, ids):
+        boards = {}
+        missing = []
+        for id in ids:
+            board = self.session.sync.boards._cached(id)
+            if board is None:
+                missing.append(id)
+            else:
+                boards[id] = board
+
+        fetched = await super().get_many(missing)
+        for board in fetched.values():
+            board.cache()
+        boards.update(fetched)
+
+        return boards
+
+    async def actions(self, id, *, fields=None):
+        params = trello._fields_params(fields or trello.Action.fields)
+        params.update(trello._fields_params(trello.Member.fields, 'member_'))
+        params.update(trello._fields_params(trello.Member.fields, 'memberCreator_'))
+
+        json = await self.session._api_get(self._sub_url(id, '/actions'), params=params)
+        return [trello.Action.from_dict(self.session.sync, d) for d in json]
+
+    async def lists(self, id, *, fields=None):
+        json = await self.session._api_get(
+            self._sub_url(id, '/lists'),
+            params=trello._fields_params(fields or trello.List.fields))
+        return [trello.List.from_dict(self.session.sync, d) for d in json]
+
+    async def members(self, id, *, fields=None):
+        json = await self.session._api_get(
+            self._sub_url(id, '/members'),
+            params=trello._fields_params(fields or trello.Member.fields))
+        return [trello.Member.from_dict(self.session.sync, d) for d in json]
+
+class AsyncListsAPI(AsyncAPI):
+    def __init__(self, session):
+        super().__init__(session, trello.List)
+
+    async def board(self, id, *, fields=None):
+        json = await self.session._api_get(
+            self._sub_url(id, '/board'),
+            params=trello._fields_params(fields or trello.Board.fields))
+        return trello.Board.from_dict(self.session.sync, json)
+
+    async def cards(self, id, *, fields=None):
+        json = await self.session._api_get(
+            self._sub_url(id, '/cards'),
+            params=trello._fields_params(fields or trello.Card.fields))
+
+        cs = [trello.Card.from_dict(self.session.sync, d) for d in json]
+        for c in cs:
+            c.id_list = id
+
+        return cs
+
+class AsyncCardsAPI(AsyncAPI):
+    def __init__(self, session):
+        super().__init__(session, trello.Card)
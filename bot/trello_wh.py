@@ -1,64 +1,262 @@
+import heapq
+import hmac
+import itertools
+import queue
 import time
 import logging
-from contextlib import contextmanager
-from datetime import datetime, timedelta
-from multiprocessing import Process
-from threading import Thread, Lock
+from threading import Condition, Thread, Lock
 
-from flask import Flask, abort, request
+from flask import Flask, abort, jsonify, request
+from werkzeug.serving import make_server
 
 import config
-from bot import trello, messages
-from bot.models import BoardHook, Session
+from bot import coalescing, messages, packing, rendering, routing
+from bot.cache import TTLCache
+from bot.debounce import AdaptiveDebounce
+from bot.outbox import Outbox
+from bot.records import ActionRecord, BoardRef, action_kind
 
 app = Flask(__name__)
 logger = logging.getLogger(__name__)
 
+# Actions changing board, list or member metadata cached by trello.App
+METADATA_ACTIONS = frozenset([
+    'updateBoard',
+    'createList', 'updateList', 'moveListToBoard', 'moveListFromBoard',
+    'addMemberToBoard', 'removeMemberFromBoard', 'makeNormalMemberOfBoard',
+    'makeAdminOfBoard', 'makeObserverOfBoard',
+])
+
+
+class FlushScheduler:
+    """
+    Single thread, flushing every message queue when its deadline expires.
+    Queues are kept in a heap keyed by deadline, so the thread only wakes up
+    when there is something to send.
+    """
+
+    def __init__(self):
+        self._heap = [] # List of (deadline, seq, queue) tuples
+        self._seq = itertools.count()
+        self._cond = Condition()
+        self._running = False
+        self._thread = None
+
+    def schedule(self, queue, deadline: float):
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, next(self._seq), queue))
+            if self._heap[0][2] is queue:
+                self._cond.notify()
+
+    def _next_due(self):
+        with self._cond:
+            while self._running:
+                if self._heap:
+                    timeout = self._heap[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        return heapq.heappop(self._heap)[2]
+                else:
+                    timeout = None
+
+                self._cond.wait(timeout)
+
+        return None
+
+    def _loop(self):
+        while True:
+            queue = self._next_due()
+            if queue is None:
+                return
+
+            try:
+                queue.flush()
+            except Exception as e:
+                logger.error("Could not flush message queue of chat id {}: {}.".format(
+                    queue.chat_id, repr(e)))
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+
+        self._thread = Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
 
 class MessageQueue:
 
-    def __init__(self, trello_bot, chat_id, board):
+    def __init__(self, trello_bot, chat_id, board, scheduler, outbox, debounce,
+                 on_empty=None):
         self.bot = trello_bot
         self.chat_id = chat_id
         self.board = board
-
-        self._queue = [] # List of message strings
-        self._queue_update = datetime.now()
+        self.scheduler = scheduler
+        self.outbox = outbox
+        self.debounce = debounce
+        self.on_empty = on_empty
+
+        self._queue = [] # List of (outbox id, ActionRecord)
+        self._first_event = None
+        self._deadline = None
+        self._scheduled = False
         self._queue_lock = Lock()
-        self._messaging_thread = Thread(target=self._messaging_loop)
-        self._messaging_thread.start()
 
-    def _messaging_loop(self):
-        while True:
-            time.sleep(1)
+    def flush(self):
+        with self._queue_lock:
+            if time.monotonic() < self._deadline:
+                # New messages arrived since the queue has been scheduled,
+                # wait for the debounce window to expire again.
+                self.scheduler.schedule(self, self._deadline)
+                return
+
+            msg_queue = self._queue
+            self._queue = []
+            self._scheduled = False
+
+        if msg_queue:
+            actions = coalescing.coalesce([a for (_, a) in msg_queue])
+            msgs = rendering.render_many(actions)
+            parts = packing.pack(msgs, self._wrap,
+                                 max_parts=getattr(config, 'NOTIFICATION_MAX_PARTS', 5),
+                                 more=messages.HOOK_MORE)
+
+            # The outbox keeps the actions until the last part is delivered,
+            # as the sender does not survive a restart. Messages to a chat
+            # are delivered in order, so the earlier parts are done by then.
+            up_to_id = msg_queue[-1][0]
+            ack = lambda: self.outbox.ack(self.chat_id, self.board.id, up_to_id)
+
+            for (i, message_to_send) in enumerate(parts):
+                last = i == len(parts) - 1
+                self.bot.send_message(self.chat_id, message_to_send,
+                                      on_sent=ack if last else None)
+            if not parts:
+                ack()
+
+        if self.on_empty:
+            self.on_empty(self)
+
+    def _wrap(self, message_list):
+        return messages.HOOK_WRAP.format(
+            board_name=self.board.name,
+            board_url=self.board.url,
+            message=message_list,
+        )
+
+    def is_empty(self):
+        with self._queue_lock:
+            return not self._scheduled
 
-            with self._queue_lock:
-                if datetime.now() - self._queue_update < timedelta(seconds=config.NOTIFICATION_LAG):
-                    continue
+    def enqueue(self, action: ActionRecord, outbox_id: int=None):
+        now = time.monotonic()
+        window = self.debounce.record((self.chat_id, self.board.id), now)
 
-                msg_queue = self._queue
-                self._queue = []
+        with self._queue_lock:
+            # Ids are allocated under the queue lock, so they are queued in
+            # order and an ack never covers an action which is not queued yet.
+            if outbox_id is None:
+                outbox_id = self.outbox.append(self.chat_id, self.board, action.to_json())
+
+            if not self._queue:
+                self._first_event = now
+            self._queue.append((outbox_id, action))
+            self._deadline = self.debounce.deadline(window, now, self._first_event)
+
+            if not self._scheduled:
+                self._scheduled = True
+                self.scheduler.schedule(self, self._deadline)
+
+
+class IngestionPool:
+    """
+    Bounded queue of raw webhook payloads, processed by a pool of worker
+    threads, so that the webhook endpoint can reply to Trello right away.
+    """
+
+    def __init__(self, handler, workers: int, maxsize: int):
+        self.handler = handler
+        self.workers = workers
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._threads = []
+        self._stats_lock = Lock()
+        self._accepted = 0
+        self._dropped = 0
+        self._processed = 0
+        self._failed = 0
+
+    def submit(self, *args) -> bool:
+        try:
+            self._queue.put_nowait(args)
+        except queue.Full:
+            with self._stats_lock:
+                self._dropped += 1
+            return False
 
-            if len(msg_queue) == 0:
-                continue
+        with self._stats_lock:
+            self._accepted += 1
+        return True
 
-            message_list = "\n\n".join([ m.strip() for m in msg_queue])
-            message_to_send = messages.HOOK_WRAP.format(
-                board_name=self.board.name,
-                board_url=self.board.url,
-                message=message_list,
-            )
+    def _work(self):
+        while True:
+            args = self._queue.get()
+            if args is None:
+                return
 
-            self.bot.send_message(self.chat_id, message_to_send)
+            try:
+                self.handler(*args)
+                failed = 0
+            except Exception as e:
+                logger.error("Could not process webhook update: {}.".format(repr(e)))
+                failed = 1
 
-    def enqueue(self, msg: str):
-        with self._queue_lock:
-            self._queue.append(msg)
-            self._queue_update = datetime.now()
+            with self._stats_lock:
+                self._processed += 1
+                self._failed += failed
+
+    def start(self):
+        for _ in range(self.workers):
+            t = Thread(target=self._work, daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'depth': self._queue.qsize(),
+                'capacity': self._queue.maxsize,
+                'accepted': self._accepted,
+                'dropped': self._dropped,
+                'processed': self._processed,
+                'failed': self._failed,
+            }
 
 
 class WebhookReciever:
+    # Per chat webhooks, registered before board webhooks were introduced
     update_url = '/webhook_update/<chat_id>'
+    # Board webhooks are registered per token, so Trello stops delivering
+    # the updates of a board to the chats of a token which lost access to it.
+    board_update_url = '/board_update/<board_id>/<token_key>'
+    telegram_update_url = '/telegram_update/<secret>'
+    stats_url = '/stats/<secret>'
 
     def __init__(self, trello_bot, host, port):
         self.bot = trello_bot
@@ -69,106 +267,108 @@ class WebhookReciever:
         self.flask = Flask(__name__)
         self.flask.add_url_rule(self.update_url, view_func=self.webhook_update,
                                 methods=['POST', 'HEAD'])
+        self.flask.add_url_rule(self.board_update_url, view_func=self.board_update,
+                                methods=['POST', 'HEAD'])
+        self.flask.add_url_rule(self.telegram_update_url, view_func=self.telegram_update,
+                                methods=['POST'])
+        self.flask.add_url_rule(self.stats_url, view_func=self.stats)
+        self.stats_secret = getattr(config, 'STATS_SECRET', None)
+
+        # Telegram updates are only accepted when the bot runs with a webhook.
+        self.telegram_base_url = getattr(config, 'TELEGRAM_WEBHOOK_URL', None)
+        self.telegram_secret = getattr(config, 'TELEGRAM_WEBHOOK_SECRET', None)
+
+        self.server = None
+        self.server_thread = None
+
+        self.scheduler = FlushScheduler()
+        self.outbox = Outbox(getattr(config, 'OUTBOX_WRITE_INTERVAL', 1))
+        self.debounce = AdaptiveDebounce(
+            min_lag=getattr(config, 'NOTIFICATION_MIN_LAG', 1),
+            max_lag=config.NOTIFICATION_LAG,
+            max_wait=getattr(config, 'NOTIFICATION_MAX_WAIT', 30),
+            half_rate=getattr(config, 'NOTIFICATION_HALF_RATE', 0.2))
+        self.message_queues = {}
+        self._message_queues_lock = Lock()
 
-        self.flask_process = None
+        self.update_counters = {'filtered': 0, 'processed': 0}
+        self._update_counters_lock = Lock()
 
-        self.message_queues = {}
+        # The same action can be delivered both by a board webhook and a
+        # per chat webhook, or by webhooks of several tokens.
+        self._recent_actions = TTLCache(maxsize=10000, ttl=600)
 
-    def callback_url(self, chat_id):
-        return "http://{host}:{port}{url}".format(
-            host=self.host,
-            port=self.port,
-            url=self.update_url.replace('<chat_id>', str(chat_id)))
-
-    @staticmethod
-    def _action_to_msg(action):
-        if action.type == 'createCard':
-            msg = messages.HOOK_CARD_CREATED.format(
-                user_name=action.member_creator().fullname,
-                card_text=action.card.name,
-                card_url=action.card.url,
-                list_name=action.list.name,
-                board_name=action.board.name,
-                board_url=action.board.url,
-            )
-        elif action.type == 'updateCard' and action.changed_field == 'idList':
-            msg = messages.HOOK_CARD_MOVED.format(
-                user_name=action.member_creator().fullname,
-                card_text=action.card.name,
-                card_url=action.card.url,
-                old_list_name=action.list_before.name,
-                new_list_name=action.list_after.name,
-                board_name=action.board.name,
-                board_url=action.board.url,
-            )
-        elif action.type == 'updateCard' and action.changed_field == 'closed':
-            msg = messages.HOOK_CARD_ARCHIVED.format(
-                user_name=action.member_creator().fullname,
-                card_text=action.card.name,
-                card_url=action.card.url,
-                list_name=action.list.name,
-                board_name=action.board.name,
-                board_url=action.board.url,
-            )
-        elif action.type == 'commentCard':
-            msg = messages.HOOK_CARD_COMMENTED.format(
-                user_name=action.member_creator().fullname,
-                card_text=action.card.name,
-                card_url=action.card.url,
-                text=action.text,
-                board_name=action.board.name,
-                board_url=action.board.url,
-            )
-        elif action.type == 'addMemberToCard':
-            if action.member.id == action.id_member_creator:
-                msg = messages.HOOK_CARD_SELF_ADDED.format(
-                    user_name=action.member_creator().fullname,
-                    card_text=action.card.name,
-                    card_url=action.card.url,
-                    board_name=action.board.name,
-                    board_url=action.board.url,
-                )
-            else:
-                msg = messages.HOOK_CARD_MEMBER_ADDED.format(
-                    user_name=action.member_creator().fullname,
-                    other_user_name=action.member.fullname,
-                    card_text=action.card.name,
-                    card_url=action.card.url,
-                    board_name=action.board.name,
-                    board_url=action.board.url,
-                )
-        elif action.type == 'removeMemberFromCard':
-            if action.member.id == action.id_member_creator:
-                msg = messages.HOOK_CARD_SELF_REMOVED.format(
-                    user_name=action.member_creator().fullname,
-                    card_text=action.card.name,
-                    card_url=action.card.url,
-                    board_name=action.board.name,
-                    board_url=action.board.url,
-                )
-            else:
-                msg = messages.HOOK_CARD_MEMBER_REMOVED.format(
-                    user_name=action.member_creator().fullname,
-                    other_user_name=action.member.fullname,
-                    card_text=action.card.name,
-                    card_url=action.card.url,
-                    board_name=action.board.name,
-                    board_url=action.board.url,
-                )
+        if getattr(config, 'WEBHOOK_ASYNC', False):
+            self.ingestion = IngestionPool(
+                self._process_action,
+                workers=getattr(config, 'INGEST_WORKERS', 4),
+                maxsize=getattr(config, 'INGEST_QUEUE_SIZE', 1000))
         else:
-            raise RuntimeError("Messages for this actions are not supported.")
+            self.ingestion = None
 
-        return msg
+    def _url(self, path):
+        return "http://{host}:{port}{path}".format(
+            host=self.host, port=self.port, path=path)
 
-    def get_message_queue(self, chat_id, board):
-        if chat_id not in self.message_queues:
-            self.message_queues[chat_id] = {}
+    def callback_url(self, chat_id):
+        return self._url(self.update_url.replace('<chat_id>', str(chat_id)))
+
+    def board_callback_url(self, board_id, trello_token):
+        return self._url(self.board_update_url
+                         .replace('<board_id>', board_id)
+                         .replace('<token_key>', routing.token_key(trello_token)))
+
+    def is_chat_callback_url(self, url):
+        return url.startswith(self._url(self.update_url.split('<')[0]))
+
+    def is_board_callback_url(self, url):
+        return url.startswith(self._url(self.board_update_url.split('<')[0]))
+
+    def telegram_callback_url(self):
+        """
+        Returns the url Telegram should post updates to,
+        or None, if updates are received with long polling.
+        """
+        if not self.telegram_base_url:
+            return None
+        if not self.telegram_secret:
+            raise RuntimeError("TELEGRAM_WEBHOOK_SECRET is required with TELEGRAM_WEBHOOK_URL")
+
+        return self.telegram_base_url.rstrip('/') + self.telegram_update_url.replace(
+            '<secret>', self.telegram_secret)
+
+    def enqueue_message(self, chat_id, board, action, outbox_id=None):
+        key = (chat_id, board.id)
+        # Held while enqueueing, so a flush cannot evict the queue in between
+        # and leave the action in a queue the dict no longer holds.
+        with self._message_queues_lock:
+            if key not in self.message_queues:
+                self.message_queues[key] = MessageQueue(
+                    self.bot, chat_id, board, self.scheduler, self.outbox,
+                    self.debounce, on_empty=self._evict_message_queue)
+
+            self.message_queues[key].enqueue(action, outbox_id=outbox_id)
+
+    def _replay_outbox(self):
+        rows = self.outbox.pending()
+        logger.info("Replaying {} notifications from the outbox.".format(len(rows)))
+
+        for row in rows:
+            if self.bot.routes.get(row.chat_id, row.board_id) is None:
+                # The board has been forgotten since.
+                self.outbox.ack(row.chat_id, row.board_id, row.id)
+                continue
 
-        chat_queues = self.message_queues[chat_id]
-        if board.id not in chat_queues:
-            chat_queues[board.id] = MessageQueue(self.bot, chat_id, board)
+            board = BoardRef(row.board_id, row.board_name, row.board_short_link)
+            self.enqueue_message(row.chat_id, board, ActionRecord.from_json(row.action),
+                                 outbox_id=row.id)
 
-        return chat_queues[board.id]
+    def _evict_message_queue(self, queue):
+        key = (queue.chat_id, queue.board.id)
+        with self._message_queues_lock:
+            # The queue could have been refilled while it was being flushed.
+            if self.message_queues.get(key) is queue and queue.is_empty():
+                del self.message_queues[key]
 
     def webhook_update(self, chat_id):
         logger.info("Webhook update, chat id {}.".format(chat_id))
@@ -176,8 +376,11 @@ class WebhookReciever:
             return "OK"
 
         try:
-            session = Session.get(Session.chat_id == chat_id)
-        except Session.DoesNotExist:
+            chat_id = int(chat_id)
+        except ValueError:
+            abort(404, 'No session with that chat id is found')
+
+        if not self.bot.routes.has_chat(chat_id):
             logger.error("No session was found for chat_id {}.".format(chat_id))
             abort(404, 'No session with that chat id is found')
 
@@ -192,47 +395,175 @@ class WebhookReciever:
             logger.error("No .model.id field was found in update of chat_id {}.".format(chat_id))
             abort(400, '.model.id field is required')
 
-        for h in session.hooks:
-            if h.board_id == id_model:
-                hook = h
-                break
-        else:
+        route = self.bot.routes.get(chat_id, id_model)
+        if route is None:
             # Trello will automatically delete the webhook,
             # when they recieve status 410.
             # Source: https://developers.trello.com/apis/webhooks
             logger.error("No webhook was found for update of chat_id {}.".format(chat_id))
             abort(410, 'Such hook does not exist')
 
-        trello_session = self.app.session(session.trello_token)
+        return self._accept_update([(chat_id, route)], data)
+
+    def board_update(self, board_id, token_key):
+        logger.info("Webhook update, board id {}.".format(board_id))
+        if request.method == 'HEAD':
+            return "OK"
+
+        data = request.json
+        if not data:
+            logger.error("No json was found in update of board {}.".format(board_id))
+            abort(400, 'Request must contain json data')
 
         try:
-            action = trello.Action.from_dict(trello_session, data['action'])
-        except (KeyError, TypeError) as e:
-            logger.error(
-                "Could not parse action json in update for chat_id {}: {}.".format(
-                    chat_id, repr(e)))
-            abort(400, '.action object is invalid')
+            id_model = data["model"]["id"]
+        except (KeyError, TypeError):
+            logger.error("No .model.id field was found in update of board {}.".format(board_id))
+            abort(400, '.model.id field is required')
+
+        if id_model != board_id:
+            logger.error("Update of board {} is about model {}.".format(board_id, id_model))
+            abort(400, '.model.id does not match the board')
+
+        targets = self.bot.routes.board_routes(board_id, token_key)
+        if not targets:
+            logger.error("No chat is hooked to board {} with token {}.".format(
+                board_id, token_key))
+            abort(410, 'Such hook does not exist')
+
+        return self._accept_update(targets, data)
+
+    def telegram_update(self, secret):
+        # The secret in the path keeps others from posting fake updates.
+        if not (self.telegram_base_url and self.telegram_secret and
+                hmac.compare_digest(secret, self.telegram_secret)):
+            abort(404)
+
+        data = request.json
+        if not data:
+            logger.error("No json was found in Telegram update.")
+            abort(400, 'Request must contain json data')
+
+        try:
+            self.bot.process_update(data)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error("Could not parse Telegram update: {}.".format(repr(e)))
+            abort(400, 'Update is invalid')
+
+        return "OK"
 
+    def _accept_update(self, targets, data):
         try:
-            msg = self._action_to_msg(action)
-        except RuntimeError:
+            (action_type, changed_field) = action_kind(data['action'])
+        except (KeyError, TypeError, AttributeError):
+            logger.error("No valid .action object was found in update.")
+            abort(400, '.action object is invalid')
+
+        if action_type in METADATA_ACTIONS:
+            board = data['action']['data'].get('board')
+            if board is not None:
+                self.app.metadata_cache.invalidate_tag(board['id'])
+
+        # Most updates are of types without notifications or which chats
+        # are not subscribed to, don't spend any more work on them.
+        event = rendering.event_bit(action_type, changed_field)
+        targets = [(c, r) for (c, r) in targets if r.subscription.wants(event)]
+        if not targets:
+            self._count_update('filtered')
+            return "OK"
+        self._count_update('processed')
+
+        if self.ingestion:
+            if not self.ingestion.submit(targets, data['action']):
+                logger.warning("Ingestion queue is full, dropped an update.")
+                abort(503, 'Too many updates')
             return "OK"
 
-        queue = self.get_message_queue(chat_id, action.board)
-        queue.enqueue(msg)
+        try:
+            self._process_action(targets, data['action'])
+        except (KeyError, TypeError) as e:
+            logger.error("Could not parse action json in update: {}.".format(repr(e)))
+            abort(400, '.action object is invalid')
+
         return "OK"
 
+    def _count_update(self, counter):
+        with self._update_counters_lock:
+            self.update_counters[counter] += 1
+
+    def _process_action(self, targets, action_json):
+        """
+        Parses the action once and queues it for every (chat id, route)
+        target subscribed to it.
+        """
+        action = ActionRecord.from_payload(action_json, rendering.event_bit,
+                                           self.app.members_cache)
+        if action is None:
+            return
+
+        for (chat_id, route) in targets:
+            if not route.subscription.matches(action):
+                continue
+
+            key = (chat_id, action.id)
+            if self._recent_actions.get(key):
+                continue
+
+            if action.member_creator_name is None:
+                member = self.app.session(route.trello_token).members.get(
+                    action.id_member_creator)
+                action.member_creator_name = member.fullname
+
+            self.enqueue_message(chat_id, action.board, action)
+            # Marked only once queued, so a redelivery after an error is not
+            # taken for a duplicate.
+            self._recent_actions.put(key, True)
+
+    def stats(self, secret):
+        # The receiver faces the internet, only those knowing the secret
+        # get to see its internals.
+        if not (self.stats_secret and hmac.compare_digest(secret, self.stats_secret)):
+            abort(404)
+
+        return jsonify({
+            'updates': dict(self.update_counters),
+            'trello_transport': self.app.transport.stats(),
+            'trello_rate': self.app.governor.stats(),
+            'members_cache': self.app.members_cache.stats(),
+            'metadata_cache': self.app.metadata_cache.stats(),
+            'ingestion': self.ingestion.stats() if self.ingestion else None,
+            'telegram_sender': self.bot.sender.stats(),
+            'debounce_windows': self.debounce.stats(time.monotonic()),
+            'webhook_reconciler': self.bot.reconciler.stats(),
+        })
+
     def start(self):
         logger.info("Starting webhook receiver in host {}, port {}.".format(
             self.host, self.port))
-        self.flask_process = Process(target=self.flask.run,
-                                     kwargs={'host': self.host, 'port': self.port})
-        self.flask_process.start()
+
+        # The server runs in a thread of the bot process, so it shares
+        # message queues, caches and connections with the bot.
+        self.outbox.start()
+        self._replay_outbox()
+        self.scheduler.start()
+        if self.ingestion:
+            self.ingestion.start()
+
+        self.server = make_server(self.host, self.port, self.flask, threaded=True)
+        self.server_thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
 
     def stop(self):
-        if not self.flask_process:
+        if not self.server:
             return
 
         logger.info("Stopping webhook receiver.")
-        self.flask_process.terminate()
-        self.flask_process = None
+        self.server.shutdown()
+        self.server_thread.join()
+        self.server = None
+        self.server_thread = None
+
+        if self.ingestion:
+            self.ingestion.stop()
+        self.scheduler.stop()
+        self.outbox.stop()
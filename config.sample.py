@@ -11,5 +11,75 @@ LOG_LEVEL = 'WARNING'
 TRELLO_WH_HOST = 'example.com'
 TRELLO_WH_PORT = 9099
 
-# In seconds
+# Telegram updates are received with long polling, unless TELEGRAM_WEBHOOK_URL
+# is set. Then Telegram posts them to the webhook receiver server, at
+# TELEGRAM_WEBHOOK_URL + '/telegram_update/' + TELEGRAM_WEBHOOK_SECRET.
+# Telegram only posts to HTTPS urls, so the receiver is expected to be behind
+# a TLS terminating proxy. The secret keeps others from posting fake updates.
+TELEGRAM_WEBHOOK_URL = None # e.g. 'https://example.com'
+TELEGRAM_WEBHOOK_SECRET = ''
+
+# Receiver statistics are served at /stats/ + STATS_SECRET.
+# They are disabled while the secret is empty.
+STATS_SECRET = ''
+
+# Notifications are batched while events keep coming. The batching window
+# adapts to the event rate of a board: a lone event waits NOTIFICATION_MIN_LAG,
+# busier boards wait up to NOTIFICATION_LAG, and nothing waits longer than
+# NOTIFICATION_MAX_WAIT. In seconds.
+NOTIFICATION_MIN_LAG = 1
 NOTIFICATION_LAG = 5
+NOTIFICATION_MAX_WAIT = 30
+# Event rate (events per second), at which the window is halfway to NOTIFICATION_LAG
+NOTIFICATION_HALF_RATE = 0.2
+# Notifications beyond this many messages per batch are summarized in one line
+NOTIFICATION_MAX_PARTS = 5
+# Pending notifications are saved to the database at this interval, in seconds
+OUTBOX_WRITE_INTERVAL = 1
+
+# Size of the keep-alive connection pool to the Trello API
+TRELLO_POOL_SIZE = 10
+# (connect, read) timeouts of Trello API requests, in seconds
+TRELLO_TIMEOUT = (5, 30)
+
+# Trello members are cached for name lookups in notifications
+MEMBER_CACHE_SIZE = 4096
+# In seconds
+MEMBER_CACHE_TTL = 3600
+
+# Boards, lists and board members are cached for commands and dialogs.
+# Webhook actions invalidate the entries of their board; the TTL (in seconds)
+# covers changes of boards without webhooks.
+METADATA_CACHE_SIZE = 4096
+METADATA_CACHE_TTL = 600
+
+# With the optional aiohttp installed (requirements-async.txt), boards of
+# /list, /forget and /filter are requested concurrently, at most
+# TRELLO_ASYNC_LIMIT at a time.
+TRELLO_ASYNC_LIMIT = 10
+
+# Trello API requests per 10 seconds, for the API key and for every token
+TRELLO_KEY_RATE_LIMIT = 300
+TRELLO_TOKEN_RATE_LIMIT = 100
+# Retries of requests rejected with 429 Too Many Requests
+TRELLO_RATE_LIMIT_RETRIES = 3
+
+# Trello webhooks are reconciled with board hooks in the background: one token
+# is checked every RECONCILE_INTERVAL seconds, fixing at most RECONCILE_BATCH
+# webhooks at a time.
+RECONCILE_INTERVAL = 60
+RECONCILE_BATCH = 5
+
+# Reply to Trello webhooks right away and process updates in the background
+WEBHOOK_ASYNC = False
+INGEST_WORKERS = 4
+# Updates beyond this many pending ones are refused with 503
+INGEST_QUEUE_SIZE = 1000
+
+# Threads sending messages to Telegram, within the Bot API rate limits
+TELEGRAM_SENDER_WORKERS = 4
+
+# Unfinished dialogs expire after DIALOG_TTL seconds without an answer, and the
+# least recently used ones are dropped when more than DIALOGS_MAX are open.
+DIALOG_TTL = 600
+DIALOGS_MAX = 1000